@@ -1,7 +1,15 @@
+import inspect
+
+
 class Adapter:
+    # False - run the class alone, not concurrently with other classes
+    parallel = True
+
     def __init__(self, credentials, *args, **kwargs):
         self.creds = credentials
-        self.init_db()
+        init = self.init_db()
+        # coroutine of "async def init_db" is awaited by async engine
+        self._init_coro = init if inspect.isawaitable(init) else None
 
     def init_db(self):
         assert False, ('init_db method have to be overwritten for %s' %
@@ -0,0 +1,235 @@
+# -*- coding:utf-8 -*-
+import asyncio
+from concurrent import futures
+from contextlib import asynccontextmanager
+import time
+
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except ImportError:
+    psycopg = None
+
+from db_test import dbms
+
+
+class AsyncSession:
+    ''' Connection of AsyncEngine to one test DB, used by DBTest as DBMS
+
+    It has the part of DBMS interface used by DBTest.steps, but statements
+    are executed by coroutines of psycopg.AsyncConnection. Params are bound
+    on client side (AsyncClientCursor) as psycopg2 does, global params are
+    shared with DBMS.
+    '''
+    def __init__(self, base, db_name, con):
+        self.db_connections = {db_name: con}
+        self.global_params = base.global_params
+        self.isolation = base.isolation
+        self.timeout = base.timeout
+        self.verbose = base.verbose
+        self.log = base.log
+        self.dbs = base.dbs
+        self.host = base.host
+        self.port = base.port
+        self.ext_db_name = base.ext_db_name
+        self.explain_plans = None
+        self.in_transaction = False
+        self.test_error = False
+        self.test_err_msg = None
+        self.exception = None
+        self.duration = 0
+
+    @classmethod
+    async def connect(cls, base, db_name):
+        con = await psycopg.AsyncConnection.connect(
+            dbname=base.ext_db_name(db_name),
+            host=base.host,
+            port=base.port,
+            user=base.username,
+            application_name=base.application_name,
+            cursor_factory=psycopg.AsyncClientCursor,
+            row_factory=dict_row)
+        session = cls(base, db_name, con)
+        con.add_notice_handler(lambda diag: session.log(
+            'yellow|    %s:  %s', diag.severity, diag.message_primary))
+        return session
+
+    async def close(self):
+        for con in self.db_connections.values():
+            await con.close()
+
+    async def sql_execute(self, db_name, query, **query_params):
+        res = None
+        con = self.db_connections[db_name]
+        started = time.time()
+        self.test_error = False
+        self.test_err_msg = None
+        self.exception = None
+        params = (dict(query_params, **self.global_params)
+                  if query_params else None)
+        cur = con.cursor()
+        try:
+            await cur.execute(query, params)
+            # result of the last statement, as psycopg2 gives
+            while cur.nextset():
+                pass
+            if cur.description is not None and cur.rowcount > 0:
+                res = await cur.fetchall()
+            if not self.in_transaction:
+                await con.commit()
+        except Exception as e:
+            await con.rollback()
+            if self.verbose:
+                try:
+                    sql = cur.mogrify(query, params)
+                except Exception as ee:
+                    sql = 'unpattern(%s %s)  %s' % (ee.__class__.__name__,
+                                                    ee, query)
+                self.test_err_msg = (
+                    "red|Exception on execute sql:\ndefault|  %s\nred|%s: %s" %
+                    ('\n  '.join(sql.split('\n')), e.__class__.__name__, e))
+            self.test_error = True
+            self.exception = e
+        finally:
+            await cur.close()
+            self.duration = time.time() - started
+        return res
+
+    def begin(self):
+        self.in_transaction = True
+
+    async def rollback(self, db_name):
+        self.in_transaction = False
+        await self.db_connections[db_name].rollback()
+
+    async def sequence_values(self, db_name):
+        return await self.sql_execute(db_name, dbms.sequence_values) or []
+
+    async def reset_sequences(self, db_name, seqs):
+        current = {s['seq']: s
+                   for s in await self.sequence_values(db_name)}
+        changed = [s for s in seqs if current.get(s['seq']) != s]
+        if changed:
+            await self.sql_execute(db_name, dbms.reset_sequences,
+                                   seqs=[s['seq'] for s in changed],
+                                   values=[s['value'] for s in changed],
+                                   called=[s['is_called'] for s in changed])
+
+    @asynccontextmanager
+    async def watchdog(self, db_name, timeout):
+        ''' Like DBMS.watchdog, the statement is cancelled by loop timer '''
+        state = {'fired': False}
+        if not timeout:
+            yield state
+            return
+        ms = '%d' % (timeout * 1000)
+        await self.sql_execute(db_name, "select set_config("
+                               "'statement_timeout', %(ms)s, false), "
+                               "set_config('lock_timeout', %(ms)s, false)",
+                               ms=ms)
+        con = self.db_connections[db_name]
+
+        def cancel():
+            state['fired'] = True
+            con.cancel()
+
+        timer = asyncio.get_running_loop().call_later(timeout, cancel)
+        try:
+            yield state
+        finally:
+            timer.cancel()
+            # cancel request could reach the server after the test
+            for attempt in range(3):
+                await self.sql_execute(db_name, 'reset statement_timeout; '
+                                       'reset lock_timeout')
+                if not self.timed_out():
+                    break
+
+    def timed_out(self):
+        return (self.test_error and
+                getattr(self.exception, 'sqlstate', None) in
+                ('57014', '55P03'))
+
+
+class AsyncEngine:
+    ''' asyncio engine of TestRunner
+
+    DB tests are run as coroutines (DBTest.arun) by sessions with
+    psycopg.AsyncConnection, up to `limit` tests use every database at once.
+    Dependent tests (see TestRunner.test_groups) are run one by one in order.
+    Tests which need blocking DBMS (see DBTest.async_runnable) are run by it
+    in a thread, one at a time.
+
+    Python test classes are run concurrently, classes with
+    "parallel = False" are run one by one after them. Coroutine (async def)
+    init_db and test_* methods are awaited.
+    '''
+    def __init__(self, runner, limit):
+        self.runner = runner
+        self.dbms = runner.dbms
+        self.limit = limit
+
+    def run_db_tests(self, tests):
+        return asyncio.run(self._run_db_tests(tests))
+
+    def run_python_tests(self, python_tests):
+        return asyncio.run(self._run_python_tests(python_tests))
+
+    async def _run_db_tests(self, tests):
+        loop = asyncio.get_running_loop()
+        order = {id(t): i for i, t in enumerate(tests)}
+        results = [None] * len(tests)
+        semaphores = {db_name: asyncio.Semaphore(self.limit)
+                      for db_name in self.dbms.dbs}
+        free = {db_name: [] for db_name in self.dbms.dbs}
+        sessions = []
+
+        async def run_test(t):
+            db_name = t.data['db']
+            async with semaphores[db_name]:
+                if free[db_name]:
+                    session = free[db_name].pop()
+                else:
+                    session = await AsyncSession.connect(self.dbms, db_name)
+                    sessions.append(session)
+                t.dbms = session
+                try:
+                    return await t.arun()
+                finally:
+                    t.dbms = self.dbms
+                    free[db_name].append(session)
+
+        async def run_group(blocking, group):
+            for t in sorted(group, key=lambda t: order[id(t)]):
+                if self.runner.stopped():
+                    return
+                if t.async_runnable():
+                    result = await run_test(t)
+                else:
+                    result = await loop.run_in_executor(blocking, t.run)
+                if self.runner.fail_fast and \
+                        not result.startswith('green| Passed'):
+                    self.runner.fast_failures += 1
+                results[order[id(t)]] = result
+
+        with futures.ThreadPoolExecutor(1) as blocking:
+            try:
+                await asyncio.gather(*(
+                    run_group(blocking, group)
+                    for group in self.runner.test_groups(tests)))
+            finally:
+                for session in sessions:
+                    await session.close()
+        return results
+
+    async def _run_python_tests(self, python_tests):
+        results = [None] * len(python_tests)
+        parallel = [i for i, pt in enumerate(python_tests) if pt.parallel()]
+        gathered = await asyncio.gather(*(python_tests[i].arun()
+                                          for i in parallel))
+        for i, res in zip(parallel, gathered):
+            results[i] = res
+        for i, pt in enumerate(python_tests):
+            if results[i] is None:
+                results[i] = await pt.arun()
+        return results
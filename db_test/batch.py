@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+import re
+
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except ImportError:
+    psycopg = None
+
+
+read_only_re = re.compile(r'^\s*(select|with|values)\b', re.I)
+
+
+def is_read_only(query):
+    ''' Query is a single select, which can be sent in pipeline '''
+    query = query.strip().rstrip(';')
+    return bool(read_only_re.match(query)) and ';' not in query
+
+
+def connect(**kwargs):
+    ''' Connection for pipelines, every statement of it is read only
+
+    Params are bound on client side (ClientCursor) as psycopg2 does.
+    '''
+    return psycopg.connect(
+        autocommit=True,
+        cursor_factory=psycopg.ClientCursor,
+        row_factory=dict_row,
+        options='-c default_transaction_read_only=on',
+        **kwargs)
+
+
+def fetch_batch(con, queries):
+    ''' Send (query, params) of queries in one pipeline
+
+    Returns list of rows (None for empty result) for each query or None if
+    some query failed, e.g. it tried to modify data.
+    '''
+    cursors = []
+    try:
+        with con.pipeline():
+            for query, params in queries:
+                cur = con.cursor()
+                cur.execute(query, params)
+                cursors.append(cur)
+        return [(cur.fetchall() or None) if cur.description else None
+                for cur in cursors]
+    except psycopg.Error:
+        return None
+    finally:
+        for cur in cursors:
+            cur.close()
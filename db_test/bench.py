@@ -0,0 +1,61 @@
+# -*- coding:utf-8 -*-
+import json
+import math
+import os
+
+
+# Welch's t above it means the difference of means is significant
+# (p < 0.01 for samples of dozens of iterations)
+significant_t = 3.0
+
+
+def percentile(samples, p):
+    ''' p-th percentile of sorted samples, linear interpolation '''
+    k = (len(samples) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return samples[lo] + (samples[hi] - samples[lo]) * (k - lo)
+
+
+def summary(samples):
+    ''' Statistics of latencies in seconds '''
+    samples = sorted(samples)
+    n = len(samples)
+    mean = sum(samples) / n
+    variance = sum((s - mean) ** 2 for s in samples) / (n - 1) if n > 1 else 0
+    return {
+        'n': n,
+        'mean': mean,
+        'stddev': math.sqrt(variance),
+        'min': samples[0],
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+    }
+
+
+def regression(base, stats, threshold):
+    ''' Slowdown of mean against base if it is significant, otherwise None
+
+    Slowdown is significant when it is more than threshold (fraction of
+    base mean) and Welch's t-test finds the difference of means.
+    '''
+    slowdown = stats['mean'] / base['mean'] - 1 if base['mean'] else 0
+    if slowdown <= threshold:
+        return None
+    error = math.sqrt(stats['stddev'] ** 2 / stats['n'] +
+                      base['stddev'] ** 2 / base['n'])
+    if error and (stats['mean'] - base['mean']) / error < significant_t:
+        return None
+    return slowdown
+
+
+def load_baseline(f_name):
+    if not os.path.exists(f_name):
+        return {}
+    with open(f_name) as f:
+        return json.load(f)
+
+
+def save_baseline(f_name, baseline):
+    with open(f_name, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
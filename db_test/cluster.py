@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+
+# test cluster does not need durability
+settings = {
+    'fsync': 'off',
+    'full_page_writes': 'off',
+    'synchronous_commit': 'off',
+    # new and rewritten tables are not written to WAL (see --unlogged)
+    'wal_level': 'minimal',
+    'max_wal_senders': '0',
+    'listen_addresses': "'127.0.0.1'",
+}
+
+
+def free_port():
+    ''' Port which is not used on localhost now '''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def default_base_dir():
+    ''' tmpfs (/dev/shm) if it is available, otherwise temp directory '''
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+
+class EphemeralCluster:
+    ''' Throwaway PostgreSQL cluster made by initdb and pg_ctl
+
+    Data directory is created in base_dir (tmpfs by default), the cluster
+    listens on a free port of localhost, connections of username are
+    trusted. stop() removes the cluster with all its data.
+    '''
+    host = '127.0.0.1'
+
+    def __init__(self, log, username, base_dir=None, bin_dir=None,
+                 init_sql=None):
+        self.log = log
+        self.username = username
+        self.base_dir = base_dir or default_base_dir()
+        self.bin_dir = bin_dir
+        self.init_sql = init_sql
+        self.data_dir = None
+        self.port = None
+
+    def command(self, name):
+        if self.bin_dir:
+            return os.path.join(os.path.expanduser(self.bin_dir), name)
+        if shutil.which(name):
+            return name
+        # binaries of debian packages are not in PATH
+        out = subprocess.run(['pg_config', '--bindir'], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+        return os.path.join(out.stdout.strip(), name)
+
+    def start(self):
+        self.data_dir = tempfile.mkdtemp(prefix='db_test_cluster_',
+                                         dir=self.base_dir)
+        self.port = free_port()
+        self.log('green|Starting cluster in %s on port %s', self.data_dir,
+                 self.port)
+        subprocess.run(
+            [self.command('initdb'), '-D', self.data_dir, '-U', self.username,
+             '-A', 'trust', '-E', 'UTF8', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL)
+        options = ' '.join(['-p %s' % self.port, "-k '%s'" % self.data_dir] +
+                           ['-c %s=%s' % s for s in settings.items()])
+        res = subprocess.run(
+            [self.command('pg_ctl'), '-D', self.data_dir, '-w',
+             '-l', os.path.join(self.data_dir, 'server.log'),
+             '-o', options, 'start'],
+            stdout=subprocess.DEVNULL)
+        if res.returncode:
+            with open(os.path.join(self.data_dir, 'server.log')) as f:
+                self.log('red|Failed to start cluster:\n%s', f.read())
+            self.stop()
+            raise RuntimeError('cluster is not started')
+        if self.init_sql:
+            self.log('green|Initializing cluster by %s', self.init_sql)
+            subprocess.run(
+                [self.command('psql'), '-X', '-q', '-v', 'ON_ERROR_STOP=1',
+                 '-h', self.host, '-p', str(self.port), '-U', self.username,
+                 '-d', 'postgres', '-f', os.path.expanduser(self.init_sql)],
+                check=True, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        if self.data_dir is None:
+            return
+        self.log('green|Removing cluster %s', self.data_dir)
+        subprocess.run(
+            [self.command('pg_ctl'), '-D', self.data_dir, '-m', 'immediate',
+             'stop'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        self.data_dir = None
@@ -0,0 +1,146 @@
+# -*- coding:utf-8 -*-
+from collections import Counter
+import hashlib
+import json
+
+
+max_diff_rows = 10
+
+
+def freeze(value):
+    ''' Hashable value which is equal for equal rows '''
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    # bytea comes as memoryview, its repr differs from run to run
+    if isinstance(value, memoryview):
+        return bytes(value)
+    return value
+
+
+def row_text(row):
+    ''' Text of row which is the same on every run '''
+    return json.dumps(freeze(row), default=str).encode('utf-8')
+
+
+def row_hash(row):
+    return hashlib.sha1(row_text(row)).digest()
+
+
+class ResultComparator:
+    ''' Compare rows of test result with expected ones
+
+    Rows can be fed by chunks, actual rows are not kept in memory except
+    bounded number of mismatches for diff. Modes:
+
+    - ordered (default) - rows are compared one by one
+    - not ordered - rows are compared as multisets by hashes of rows
+    - digest - only "<rows count>:<sha1>" of result is compared, the hash
+      does not depend on order of rows when ordered is False
+    '''
+    def __init__(self, expected, ordered=True, digest=None):
+        self.expected = expected
+        self.ordered = ordered
+        self.digest = digest
+        self.count = 0
+        self.fed = False
+        self.mismatches = []
+        self.mismatch_count = 0
+        self.hasher = hashlib.sha1()
+        self.hash_sum = 0
+        self.missing = None
+        if not ordered and not digest and isinstance(expected, list):
+            self.expected_rows = {freeze(r): r for r in expected}
+            self.missing = Counter(freeze(r) for r in expected)
+
+    def feed(self, rows):
+        if rows is None:
+            return
+        self.fed = True
+        for row in rows:
+            if self.digest:
+                self.feed_digest(row)
+            elif self.missing is not None:
+                key = freeze(row)
+                if self.missing[key] > 0:
+                    self.missing[key] -= 1
+                else:
+                    self.add_mismatch(('extra', row))
+            elif isinstance(self.expected, list):
+                if self.count >= len(self.expected) or \
+                        self.expected[self.count] != row:
+                    self.add_mismatch((self.count, row))
+            self.count += 1
+
+    def feed_digest(self, row):
+        if self.ordered:
+            self.hasher.update(row_text(row))
+        else:
+            self.hash_sum = (self.hash_sum +
+                             int.from_bytes(row_hash(row), 'big')) % (1 << 160)
+
+    def add_mismatch(self, mismatch):
+        self.mismatch_count += 1
+        if len(self.mismatches) < max_diff_rows:
+            self.mismatches.append(mismatch)
+
+    def actual_digest(self):
+        if self.ordered:
+            return '%s:%s' % (self.count, self.hasher.hexdigest())
+        return '%s:%040x' % (self.count, self.hash_sum)
+
+    def equal(self):
+        if self.digest:
+            return self.actual_digest() == self.digest
+        if not isinstance(self.expected, list) or not self.fed:
+            return not self.fed and self.expected is None
+        if self.missing is not None:
+            return self.mismatch_count == 0 and not +self.missing
+        return (self.mismatch_count == 0 and
+                self.count == len(self.expected))
+
+    def diff(self):
+        ''' Bounded description of difference '''
+        if self.digest:
+            return ("yellow|    expected digest:\n"
+                    "default|      %s\n"
+                    "yellow|    does not match actual:\n"
+                    "default|      %s" % (self.digest, self.actual_digest()))
+        if not isinstance(self.expected, list) or not self.fed:
+            return ("yellow|    expected result:\n"
+                    "default|      %s\n"
+                    "yellow|    does not match actual %s rows" %
+                    (self.expected, self.count if self.fed else None))
+        lines = ["yellow|    expected %s rows, actual %s rows" %
+                 (len(self.expected), self.count)]
+        if self.missing is not None:
+            missing = [self.expected_rows[key]
+                       for key in (+self.missing).elements()]
+            lines.extend(self.rows_diff('missing', missing, len(missing)))
+            lines.extend(self.rows_diff(
+                'unexpected', [row for _, row in self.mismatches],
+                self.mismatch_count))
+        else:
+            if self.mismatches:
+                lines.append("yellow|    first mismatched rows:")
+            for i, row in self.mismatches:
+                expected = (self.expected[i] if i < len(self.expected)
+                            else '<no row>')
+                lines.append("default|      %s: expected %s\n"
+                             "default|      %s  actual   %s" %
+                             (i, expected, ' ' * len(str(i)), row))
+            if self.mismatch_count > len(self.mismatches):
+                lines.append("default|      ... %s more" %
+                             (self.mismatch_count - len(self.mismatches)))
+        return '\n'.join(lines)
+
+    def rows_diff(self, title, rows, count):
+        if not count:
+            return []
+        lines = ["yellow|    %s rows (%s):" % (title, count)]
+        lines.extend("default|      %s" % (row, )
+                     for row in rows[:max_diff_rows])
+        if count > max_diff_rows:
+            lines.append("default|      ... %s more" % (count - max_diff_rows))
+        return lines
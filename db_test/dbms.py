@@ -1,46 +1,121 @@
 # -*- coding:utf-8 -*-
+from collections import OrderedDict
+from concurrent import futures
+from contextlib import contextmanager
+import copy
+import hashlib
+import itertools
+import json
 import os
+import re
+import shutil
+import threading
 import time
+import uuid
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import subprocess
 
 from pg_import import executor
 
+from db_test import batch
+from db_test import explain
+from db_test import loader
+from db_test import sources
+
 
 time_format = '%Y-%m-%d %h:%M:%s'
 
-refresh_seq = """
-    do language plpgsql $$
-    declare
-      r record;
-      t integer;
-      s integer;
-    begin
-      for r in
-        select dep.deptype, cl.relname, att.attname, nsc.nspname,
-               seq.relname as seqname, nss.nspname as seqnsp
-          from pg_class seq
-          join pg_namespace nss ON seq.relnamespace = nss.oid
-          join pg_depend dep on dep.objid = seq.oid
-          join pg_class cl ON dep.refobjid = cl.oid
-          join pg_attribute att ON dep.refobjid=att.attrelid AND
-                dep.refobjsubid=att.attnum
-          join pg_namespace nsc ON cl.relnamespace=nsc.oid
-         where seq.relkind = 'S' and deptype = 'a'
-      loop
-        execute format('select coalesce(max(%I), 0)
-                          from %I.%I',
-                       r.attname, r.nspname, r.relname) into t;
-        execute format('select last_value - (not is_called)::int
-                          from %I.%I',
-                       r.seqnsp, r.seqname) into s;
-
-        if t <> s then
-          perform setval(r.seqnsp ||'.'||r.seqname, t, true);
-        end if;
-      end loop;
-    end;$$;"""
+owned_sequences = """
+    select format('%I.%I', s.schemaname, s.sequencename) as seq,
+           format('%I.%I', nsc.nspname, cl.relname) as tbl,
+           quote_ident(att.attname) as col,
+           coalesce(s.last_value, s.start_value - 1) as last_value
+      from pg_sequences s
+      join pg_namespace nss on nss.nspname = s.schemaname
+      join pg_class seq on seq.relnamespace = nss.oid and
+                           seq.relname = s.sequencename
+      join pg_depend dep on dep.objid = seq.oid and
+                            dep.classid = 'pg_class'::regclass and
+                            dep.deptype in ('a', 'i')
+      join pg_class cl on dep.refobjid = cl.oid
+      join pg_attribute att on dep.refobjid = att.attrelid and
+                               dep.refobjsubid = att.attnum
+      join pg_namespace nsc on cl.relnamespace = nsc.oid
+     -- skip tables which are empty according to statistics,
+     -- since 14 never analyzed tables have reltuples = -1
+     where not (cl.reltuples = 0 and
+                current_setting('server_version_num')::int >= 140000)"""
+
+set_sequences = """
+    select setval(s::regclass, v, true)
+      from unnest(%(seqs)s::text[], %(values)s::bigint[]) as u(s, v)"""
+
+# nextval is not transactional, rolled back statements still move sequences
+sequence_values = """
+    select format('%I.%I', schemaname, sequencename) as seq,
+           coalesce(last_value, start_value) as value,
+           last_value is not null as is_called
+      from pg_sequences"""
+
+reset_sequences = """
+    select setval(s::regclass, v, c)
+      from unnest(%(seqs)s::text[], %(values)s::bigint[],
+                  %(called)s::boolean[]) as u(s, v, c)"""
+
+preparable_re = re.compile(r'^\s*(select|with|insert|update|delete|values)\b',
+                           re.I)
+placeholder_re = re.compile(r'%\((\w+)\)s|%%|%')
+
+
+def numeric_placeholders(query):
+    ''' Convert %(name)s placeholders of query to $n for prepare
+
+    Returns (text, names), where names are params in order of $n, or None
+    if query can not be prepared (several statements, positional params).
+    '''
+    query = query.strip().rstrip(';')
+    if ';' in query or not preparable_re.match(query):
+        return None
+    names = []
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(0) == '%':
+            raise ValueError('unsupported placeholder')
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return '$%s' % (names.index(match.group(1)) + 1)
+
+    try:
+        return placeholder_re.sub(replace, query), names
+    except ValueError:
+        return None
+
+
+template_comment = 'db_test template %s %d'
+
+permanent_tables = """
+    select format('%I.%I', n.nspname, c.relname) as tbl
+      from pg_class c
+      join pg_namespace n on n.oid = c.relnamespace
+     where c.relkind = 'r' and
+           c.relpersistence = 'p' and
+           n.nspname not in ('pg_catalog', 'information_schema') and
+           n.nspname not like 'pg_toast%%' and
+           -- tables of extensions
+           not exists (select
+                         from pg_depend d
+                        where d.classid = 'pg_class'::regclass and
+                              d.objid = c.oid and
+                              d.deptype = 'e')"""
+
+cached_templates = """
+    select datname, shobj_description(oid, 'pg_database') as descr
+      from pg_database
+     where shobj_description(oid, 'pg_database') like %(pattern)s"""
 
 
 class DBMS:
@@ -56,7 +131,39 @@ class DBMS:
         self.test_dir = args.test_dir
         self.db_dirs = args.db_dirs
         self.db_name = args.db_name
+        self.template_cache = args.template_cache
+        self.isolation = args.rollback
+        self.load_jobs = args.load_jobs
+        self.itersize = args.itersize
+        self.prepared_cache = args.prepared_cache
+        # db_name -> OrderedDict(normalized query -> (name, params) or None)
+        self.prepared = {}
+        self.prepared_names = itertools.count(1)
+        self.prepared_hits = 0
+        self.prepared_misses = 0
+        self.batch_connections = {}
+        self.reuse = args.reuse
+        self.snapshot_cache = args.snapshot_cache
+        self.restore_jobs = args.restore_jobs
+        self.fast_build = args.fast_build
+        self.unlogged = args.unlogged
+        self.build_maintenance_work_mem = args.build_maintenance_work_mem
+        self.cache_dir = os.path.expanduser(args.cache_dir)
+        self.in_transaction = False
+        # auto_explain notices are collected here instead of log, if list
+        self.explain_plans = None
+        self.timeout = args.timeout
+        self.pool_size = args.pool_size
+        # db_name -> connection pool shared by python tests
+        self.pools = {}
+        self.pools_lock = threading.Lock()
         self.ext_name = time.strftime('_test_%Y%m%d%H%M%S')
+        self.suffix = ''
+        # (db_name, phase, duration) of build
+        self.phases = []
+        self.duration = 0
+        self.workers = []
+        self.sessions = []
         self.dbs = dict([d.split(':') for d in self.db_dirs])
         self.db_connections = {}
         self.connect_db(
@@ -68,7 +175,7 @@ class DBMS:
         self.global_params = {}
 
     def ext_db_name(self, db_name):
-        return self.db_name or db_name + self.ext_name
+        return (self.db_name or db_name + self.ext_name) + self.suffix
 
     def drop_db(self):
         for db_name in self.dbs:
@@ -80,15 +187,74 @@ class DBMS:
                 print("Error: Drop DB is failed, due to: %s" % e)
 
     def clean_all(self):
+        for worker in self.workers:
+            worker.clean_all()
         self.disconnect_db()
         self.drop_db()
 
-    def process_pg_import(self, section, db_dir, db_name, schema=None):
+    def copy(self, suffix=''):
+        ''' Copy of DBMS with its own state, databases are not connected '''
+        worker = copy.copy(self)
+        worker.suffix = self.suffix + suffix
+        worker.workers = []
+        worker.sessions = []
+        worker.db_connections = {'sys': self.db_connections['sys']}
+        worker.global_params = {}
+        worker.prepared = {}
+        worker.prepared_hits = 0
+        worker.prepared_misses = 0
+        worker.batch_connections = {}
+        worker.explain_plans = None
+        worker.pools = {}
+        worker.pools_lock = threading.Lock()
+        return worker
+
+    def session(self):
+        ''' Copy of DBMS with own connections to the same databases '''
+        session = self.copy()
+        for db_name in self.dbs:
+            session.connect_db(db_name, self.ext_db_name(db_name))
+        self.sessions.append(session)
+        return session
+
+    def close_sessions(self):
+        for session in self.sessions:
+            for db_name in self.dbs:
+                session.db_connections.pop(db_name).close()
+                if db_name in session.batch_connections:
+                    session.batch_connections.pop(db_name).close()
+
+    def clone(self, count):
+        ''' Copy built databases into count workers with own connections '''
+        self.workers = [self.copy('_w%s' % (i + 1)) for i in range(count)]
+
+        for db_name in self.dbs:
+            ext_db_name = self.ext_db_name(db_name)
+            # database can not be used as template while somebody connected
+            self.db_connections.pop(db_name).close()
+            for worker in self.workers:
+                self.log('green|Cloning db %s into %s', ext_db_name,
+                         worker.ext_db_name(db_name))
+                with self.phase(db_name, 'clone'):
+                    # worker kept by previous run (--keep) is outdated
+                    self.sql_execute('sys', 'drop database if exists %s' %
+                                     worker.ext_db_name(db_name))
+                    self.sql_execute('sys', 'create database %s template %s' %
+                                     (worker.ext_db_name(db_name), ext_db_name))
+                if self.test_error:
+                    raise Exception('Failed to clone db %s: %s' %
+                                    (ext_db_name, self.exception))
+                worker.connect_db(db_name, worker.ext_db_name(db_name))
+            self.connect_db(db_name, ext_db_name)
+        return self.workers
+
+    def process_pg_import(self, section, db_dir, db_name, schema=None,
+                          database=None):
         """ Get commands from pg_import and execute them """
         # final_string = 'set client_min_messages to warning;\n' + pg_cmds.read()
         executor.Executor(
             {section}, schema, db_dir,
-            database=self.ext_db_name(db_name),
+            database=database or self.ext_db_name(db_name),
             host=self.host,
             port=self.port,
             user=self.username,
@@ -107,29 +273,525 @@ class DBMS:
                               stderr=subprocess.PIPE)
 
     def build_db(self):
-        for db_name, db_dir in self.dbs.items():
-            ext_db_name = self.ext_db_name(db_name)
-            self.log('green|Creating db %s (%s)', db_name, ext_db_name)
-            self.sql_execute('sys', 'create database %s' % ext_db_name)
-            self.log('green|Creating schema')
+        ''' Build all databases concurrently, one thread per database
+
+        Every thread builds by its own copy of DBMS, so errors of statements
+        (test_error, exception) of one build are not seen by others.
+        '''
+        builders = {db_name: self.copy() for db_name in self.dbs}
+        with futures.ThreadPoolExecutor(len(self.dbs)) as pool:
+            builds = [pool.submit(builders[db_name].build_one_db, db_name,
+                                  db_dir)
+                      for db_name, db_dir in self.dbs.items()]
+            # re-raise the first error of build
+            for build in builds:
+                build.result()
+        for db_name, builder in builders.items():
+            self.db_connections[db_name] = builder.db_connections[db_name]
+
+    def build_one_db(self, db_name, db_dir):
+        started = time.time()
+        ext_db_name = self.ext_db_name(db_name)
+        if self.reuse:
+            with self.phase(db_name, 'reuse'):
+                reused = self.reuse_db(db_name, db_dir)
+            if reused:
+                self.log('green|DB %s is updated in %.1fs', db_name,
+                         time.time() - started)
+                return
+            self.sql_execute('sys', 'drop database if exists %s' % ext_db_name)
+        if self.template_cache:
+            with self.phase(db_name, 'template'):
+                template = self.prepare_template(db_name, db_dir)
+            self.log('green|Creating db %s (%s) from template %s',
+                     db_name, ext_db_name, template)
+            with self.phase(db_name, 'create from template'):
+                self.sql_execute('sys', 'create database %s template %s' %
+                                 (ext_db_name, template))
+            self.log('green|DB connecting %s', db_name)
             self.connect_db(db_name, ext_db_name)
-            self.process_pg_import('pre-data', db_dir, db_name)
+        else:
+            self.build_target(db_name, db_dir, ext_db_name)
+        if self.reuse:
+            self.save_manifest(db_name, self.source_manifest(db_name, db_dir))
+        self.phases.append((db_name, 'total', time.time() - started))
+        self.log('green|DB %s is built in %.1fs', db_name, time.time() - started)
 
-            self.log('green|Loading default data')
-            self.process_pg_import('data', db_dir, db_name)
+    def build_target(self, db_name, db_dir, target):
+        ''' Restore target from snapshot of db_dir or load it
+
+        Snapshot (directory-format dump) is taken in cache_dir after load,
+        so the next runs (even on other clusters) restore it by parallel
+        pg_restore instead of loading db_dir again.
+        '''
+        if not self.snapshot_cache:
+            return self.load_db(db_name, db_dir, target)
+        snapshot = os.path.join(
+            self.cache_dir, 'snapshots', db_name,
+            self.fingerprint(db_name, db_dir, exact_version=False)[:16])
+        if os.path.exists(snapshot):
+            self.log('green|Restoring db %s (%s) from snapshot %s',
+                     db_name, target, snapshot)
+            with self.phase(db_name, 'restore'):
+                restored = self.restore_snapshot(snapshot, target)
+            if restored:
+                self.connect_db(db_name, target)
+                return
+            self.log('yellow|Failed to restore snapshot, rebuild')
+            self.sql_execute('sys', 'drop database if exists %s' % target)
+        self.load_db(db_name, db_dir, target)
+        self.log('green|Saving snapshot of %s to %s', db_name, snapshot)
+        with self.phase(db_name, 'snapshot'):
+            self.save_snapshot(snapshot, target)
+
+    def pg_client_args(self):
+        args = ['-U', self.username]
+        if self.host:
+            args += ['-h', self.host]
+        if self.port:
+            args += ['-p', str(self.port)]
+        return args
+
+    def restore_snapshot(self, snapshot, target):
+        self.sql_execute('sys', 'create database %s' % target)
+        if self.test_error:
+            return False
+        res = subprocess.run(
+            ['pg_restore', '-j', str(self.restore_jobs), '-d', target] +
+            self.pg_client_args() + [snapshot],
+            stderr=subprocess.PIPE, universal_newlines=True)
+        if res.returncode:
+            self.log('yellow|%s', res.stderr.strip())
+        return res.returncode == 0
+
+    def save_snapshot(self, snapshot, target):
+        ''' Dump target into snapshot, drop other snapshots of the db '''
+        tmp_path = snapshot + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        res = subprocess.run(
+            ['pg_dump', '-Fd', '-j', str(self.restore_jobs), '-f', tmp_path] +
+            self.pg_client_args() + [target],
+            stderr=subprocess.PIPE, universal_newlines=True)
+        if res.returncode:
+            self.log('yellow|Failed to save snapshot: %s', res.stderr.strip())
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        snapshots = os.path.dirname(snapshot)
+        for old in os.listdir(snapshots):
+            if old != os.path.basename(tmp_path):
+                shutil.rmtree(os.path.join(snapshots, old), ignore_errors=True)
+        os.replace(tmp_path, snapshot)
+
+    @contextmanager
+    def phase(self, db_name, name):
+        ''' Measure duration of build phase '''
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((db_name, name, time.time() - started))
+
+    def load_db(self, db_name, db_dir, target):
+        ''' Create database target and fill it from db_dir and test data '''
+        started = time.time()
+        start_lsn = self.wal_lsn()
+        self.log('green|Creating db %s (%s)', db_name, target)
+        with self.phase(db_name, 'create'):
+            self.sql_execute('sys', 'create database %s' % target)
+            if self.fast_build:
+                self.relax_durability(target)
+        self.log('green|Creating schema of %s', db_name)
+        self.connect_db(db_name, target)
+        with self.phase(db_name, 'pre-data'):
+            self.process_pg_import('pre-data', db_dir, db_name,
+                                   database=target)
+
+        unlogged = []
+        wal_level = self.wal_level() if self.unlogged else None
+        if self.unlogged and wal_level != 'minimal':
+            # SET LOGGED writes the whole table to WAL above minimal level
+            self.log('yellow|--unlogged is skipped for %s: wal_level is %s, '
+                     'not minimal', db_name, wal_level)
+        elif self.unlogged:
+            with self.phase(db_name, 'set unlogged'):
+                unlogged = self.set_persistence(db_name, 'unlogged')
+
+        test_data = os.path.join(self.test_dir, 'data', db_name)
+        if self.load_jobs:
+            self.log('green|Loading default and test data into %s by COPY',
+                     db_name)
+            with self.phase(db_name, 'data'):
+                self.copy_data(target,
+                               [os.path.join(db_dir, 'data'), test_data])
+        else:
+            self.log('green|Loading default data into %s', db_name)
+            with self.phase(db_name, 'data'):
+                self.process_pg_import('data', db_dir, db_name,
+                                       database=target)
 
-            test_data = os.path.join(self.test_dir, 'data', db_name)
             if os.path.exists(test_data):
                 self.log('green|Loading test data into database %s' % db_name)
-                self.process_pg_import('data', self.test_dir, db_name, db_name)
+                with self.phase(db_name, 'test data'):
+                    self.process_pg_import('data', self.test_dir, db_name,
+                                           db_name, database=target)
 
-            self.log('green|Creating constraint')
-            self.process_pg_import('post-data', db_dir, db_name)
+        if unlogged:
+            # before post-data, so indexes are not rewritten with tables
+            with self.phase(db_name, 'set logged'):
+                self.set_persistence(db_name, 'logged', unlogged)
 
-            self.log('green|DB connecting %s', db_name)
-            self.sql_execute(db_name, refresh_seq)
+        self.log('green|Creating constraint of %s', db_name)
+        with self.phase(db_name, 'post-data'):
+            self.process_pg_import('post-data', db_dir, db_name,
+                                   database=target)
+
+        self.log('green|DB connecting %s', db_name)
+        with self.phase(db_name, 'refresh sequences'):
+            self.refresh_sequences(db_name)
+
+        if self.fast_build:
+            with self.phase(db_name, 'analyze'):
+                self.sql_execute(db_name, 'analyze')
+            self.restore_durability(db_name, target)
+        self.report_build(db_name, time.time() - started,
+                          self.wal_bytes(start_lsn))
+
+    def relax_durability(self, target):
+        ''' Settings of fast build for every session of target
+
+        Database level settings are used, because pg_import and COPY
+        workers connect by themselves.
+        '''
+        self.sql_execute('sys', 'alter database %s set synchronous_commit '
+                         'to off' % target)
+        self.sql_execute('sys', "alter database %s set maintenance_work_mem "
+                         "to '%s'" % (target, self.build_maintenance_work_mem))
+
+    def restore_durability(self, db_name, target):
+        for setting in ('synchronous_commit', 'maintenance_work_mem'):
+            self.sql_execute('sys', 'alter database %s reset %s' %
+                             (target, setting))
+        # session keeps database settings it was started with
+        self.db_connections.pop(db_name).close()
+        self.connect_db(db_name, target)
+
+    def set_persistence(self, db_name, persistence, tables=None):
+        ''' Alter persistence of tables (all permanent ones by default)
+
+        Tables which can not be altered (e.g. referenced by foreign keys of
+        other tables) are skipped, altered ones are returned. Failed tables
+        are altered again while it succeeds for some of them, so referenced
+        tables do not have to be altered first.
+        '''
+        if tables is None:
+            tables = [r['tbl'] for r in
+                      self.sql_execute(db_name, permanent_tables) or []]
+        altered = []
+        while tables:
+            failed = []
+            for table in tables:
+                self.sql_execute(db_name, 'alter table %s set %s' %
+                                 (table, persistence))
+                (failed if self.test_error else altered).append(table)
+            if len(failed) == len(tables):
+                break
+            tables = failed
+        if tables:
+            self.log('yellow|Failed to set %s %s tables of %s: %s',
+                     persistence, len(tables), db_name, self.exception)
+        return altered
+
+    def wal_level(self):
+        res = self.sql_execute(
+            'sys', "select current_setting('wal_level') as wal_level")
+        return res[0]['wal_level'] if res else None
+
+    def wal_lsn(self):
+        res = self.sql_execute('sys',
+                               'select pg_current_wal_lsn()::text as lsn')
+        return res[0]['lsn'] if res else None
+
+    def wal_bytes(self, start_lsn):
+        ''' WAL written by the cluster since start_lsn '''
+        if start_lsn is None:
+            return None
+        res = self.sql_execute(
+            'sys', 'select pg_wal_lsn_diff(pg_current_wal_lsn(), '
+            '%(start)s)::bigint as bytes', start=start_lsn)
+        return res[0]['bytes'] if res else None
+
+    def report_build(self, db_name, duration, wal):
+        ''' Log duration and WAL of load, compare fast and normal builds
+
+        The last stats of every profile are kept in cache_dir. WAL is
+        written by the whole cluster, so concurrent builds are included.
+        '''
+        profile = 'fast' if self.fast_build else 'normal'
+        stats_path = os.path.join(self.cache_dir, 'build_%s.json' % db_name)
+        stats = {}
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats = json.load(f)
+        stats[profile] = {'duration': duration, 'wal': wal}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(stats_path, 'w') as f:
+            json.dump(stats, f)
+        self.log('green|DB %s is loaded in %.1fs, %s MB of WAL (%s build)',
+                 db_name, duration,
+                 '?' if wal is None else '%.1f' % (wal / 2 ** 20), profile)
+        normal = stats.get('normal')
+        if self.fast_build and normal:
+            self.log('green|Fast build of %s saved %.1fs (%.0f%%)%s against '
+                     'the last normal build', db_name,
+                     normal['duration'] - duration,
+                     100 * (1 - duration / normal['duration'])
+                     if normal['duration'] else 0,
+                     ' and %.1f MB of WAL' % ((normal['wal'] - wal) / 2 ** 20)
+                     if normal['wal'] is not None and wal is not None
+                     else '')
+
+    def sequence_values(self, db_name):
+        return self.sql_execute(db_name, sequence_values) or []
+
+    def reset_sequences(self, db_name, seqs):
+        ''' Set sequences back to values got by sequence_values '''
+        current = {s['seq']: s for s in self.sequence_values(db_name)}
+        changed = [s for s in seqs if current.get(s['seq']) != s]
+        if changed:
+            self.sql_execute(db_name, reset_sequences,
+                             seqs=[s['seq'] for s in changed],
+                             values=[s['value'] for s in changed],
+                             called=[s['is_called'] for s in changed])
+
+    def refresh_sequences(self, db_name):
+        ''' Set sequences owned by columns to max value of the column '''
+        started = time.time()
+        seqs = self.sql_execute(db_name, owned_sequences) or []
+        max_values = []
+        if seqs:
+            max_values = self.sql_execute(db_name, '\n union all '.join(
+                'select %s as i, max(%s)::bigint as value from %s' %
+                (i, s['col'], s['tbl']) for i, s in enumerate(seqs))) or []
+        changed = [(seqs[r['i']]['seq'], r['value']) for r in max_values
+                   if r['value'] is not None and
+                   r['value'] != seqs[r['i']]['last_value']]
+        if changed:
+            self.sql_execute(db_name, set_sequences,
+                             seqs=[c[0] for c in changed],
+                             values=[c[1] for c in changed])
+        self.log('green|Refreshed %s of %s sequences of %s in %.2fs',
+                 len(changed), len(seqs), db_name, time.time() - started)
+
+    def copy_data(self, target, paths):
+        ''' Load data files from paths into target in parallel connections
+
+        Every connection loads its own part of files, the biggest files are
+        spread first. Constraints and indexes are created later by post-data.
+        '''
+        files = loader.data_files(os.path.expanduser(p) for p in paths)
+        jobs = [[] for i in range(min(self.load_jobs, len(files)))]
+        sizes = [0] * len(jobs)
+        for f_name in files:
+            i = sizes.index(min(sizes))
+            jobs[i].append(f_name)
+            sizes[i] += os.path.getsize(f_name)
+
+        def load(f_names):
+            con = psycopg2.connect(
+                dbname=target,
+                host=self.host,
+                port=self.port,
+                user=self.username,
+                application_name=self.application_name)
+            try:
+                for f_name in f_names:
+                    loader.load_file(con, f_name)
+            finally:
+                con.close()
+
+        with futures.ThreadPoolExecutor(len(jobs) or 1) as pool:
+            for job in [pool.submit(load, j) for j in jobs]:
+                job.result()
+
+    def source_manifest(self, db_name, db_dir):
+        return sources.source_manifest({
+            'db': os.path.expanduser(db_dir),
+            'test-data': os.path.join(self.test_dir, 'data', db_name),
+        })
+
+    def manifest_path(self, db_name):
+        return os.path.join(self.cache_dir,
+                            '%s.json' % self.ext_db_name(db_name))
+
+    def save_manifest(self, db_name, manifest):
+        ''' Remember files which kept database is built from '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.manifest_path(db_name), 'w') as f:
+            json.dump(manifest, f)
+
+    def source_path(self, db_name, db_dir, key):
+        prefix, rel_path = key.split(os.sep, 1)
+        if prefix == 'db':
+            return os.path.join(os.path.expanduser(db_dir), rel_path)
+        return os.path.join(self.test_dir, 'data', db_name, rel_path)
+
+    def reuse_db(self, db_name, db_dir):
+        ''' Reapply changed functions, views and data to kept database
+
+        Returns False when database has to be rebuilt: there is no database
+        or manifest of its files, some files are removed or definition of
+        other objects (tables, types, etc.) is changed.
+        '''
+        ext_db_name = self.ext_db_name(db_name)
+        exists = self.sql_execute(
+            'sys', 'select 1 from pg_database where datname = %(name)s',
+            name=ext_db_name)
+        if not exists or not os.path.exists(self.manifest_path(db_name)):
+            return False
+        with open(self.manifest_path(db_name)) as f:
+            old = json.load(f)
+        new = self.source_manifest(db_name, db_dir)
+        if set(old) - set(new):
+            self.log('yellow|Files of %s are removed, rebuild', db_name)
+            return False
+        changed = {}
+        for key in new:
+            if old.get(key, [None])[0] != new[key][0]:
+                kind = sources.source_kind(key)
+                # new signature makes an overload, the old one stays in db
+                if kind == 'function' and key in old and \
+                        old[key][1] != new[key][1]:
+                    kind = 'schema'
+                changed.setdefault(kind, []).append(key)
+        if 'schema' in changed:
+            self.log('yellow|Definition of %s is changed (%s), rebuild',
+                     db_name, changed['schema'][0])
+            return False
+
+        self.log('green|Reusing db %s (%s)', db_name, ext_db_name)
+        self.connect_db(db_name, ext_db_name)
+        for key in changed.get('function', []) + changed.get('view', []):
+            self.log('green|  reapply %s', key)
+            with open(self.source_path(db_name, db_dir, key)) as f:
+                self.sql_execute(db_name, f.read())
+            if self.test_error:
+                self.log('yellow|Failed to reapply %s, rebuild', key)
+                self.db_connections.pop(db_name).close()
+                return False
+        if changed.get('data'):
+            if not self.reload_data(db_name, db_dir, changed['data'], old, new):
+                self.db_connections.pop(db_name).close()
+                return False
+            self.refresh_sequences(db_name)
+        self.save_manifest(db_name, new)
+        return True
+
+    def reload_data(self, db_name, db_dir, keys, old, new):
+        ''' Truncate tables of changed data files and load all their files '''
+        tables = set()
+        for key in keys:
+            tables.update(old.get(key, [None, []])[1], new[key][1])
+        reload = [key for key in new
+                  if sources.source_kind(key) == 'data' and
+                  tables.intersection(new[key][1])]
+        self.log('green|  reload %s', ', '.join(sorted(tables)))
+        if tables:
+            self.sql_execute(db_name, 'truncate %s' % ', '.join(tables))
+            if self.test_error:
+                self.log('yellow|Failed to truncate tables, rebuild')
+                return False
+        con = self.db_connections[db_name]
+        try:
+            for key in reload:
+                loader.load_file(con, self.source_path(db_name, db_dir, key))
+        except psycopg2.Error as e:
+            con.rollback()
+            self.log('yellow|Failed to reload data (%s), rebuild', e)
+            return False
+        return True
+
+    def fingerprint(self, db_name, db_dir, exact_version=True):
+        ''' Hash of db_dir, test data of db_name and server version
+
+        Only major version is hashed when not exact_version.
+        '''
+        hasher = hashlib.sha1()
+        sources.dir_fingerprint(hasher, os.path.expanduser(db_dir))
+        test_data = os.path.join(self.test_dir, 'data', db_name)
+        if os.path.exists(test_data):
+            hasher.update(b'\0test-data\0')
+            sources.dir_fingerprint(hasher, test_data)
+        version = self.sql_execute(
+            'sys', 'show server_version_num')[0]['server_version_num']
+        if not exact_version:
+            version = str(int(version) // 10000)
+        hasher.update(version.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def prepare_template(self, db_name, db_dir):
+        ''' Return name of template database with built db_dir
+
+        Template is looked up by fingerprint of its sources. On cache miss it
+        is built once and kept for next runs, only the last
+        self.template_cache templates of db_name are kept (LRU).
+        '''
+        template = '%s_tpl_%s' % (db_name, self.fingerprint(db_name, db_dir)[:16])
+        templates = self.cached_templates(db_name)
+        if template in templates:
+            self.log('green|Using cached template %s', template)
+        else:
+            self.build_template(db_name, db_dir, template)
+        self.sql_execute('sys', "comment on database %s is '%s'" %
+                         (template, template_comment % (db_name, time.time())))
+        templates[template] = time.time()
+        self.evict_templates(templates)
+        return template
+
+    def build_template(self, db_name, db_dir, template):
+        ''' Build template under unique name and rename it when it is ready
+
+        Concurrent runs on the same cluster do not see (and drop) template
+        which is not built yet. When the template is built by another run
+        first, own copy is dropped.
+        '''
+        building = '%s_b%s' % (template, uuid.uuid4().hex[:8])
+        try:
+            self.build_target(db_name, db_dir, building)
+        except Exception:
+            if db_name in self.db_connections:
+                self.db_connections.pop(db_name).close()
+            self.sql_execute('sys', 'drop database if exists %s' % building)
+            raise
+        self.db_connections.pop(db_name).close()
+        self.sql_execute('sys', 'alter database %s rename to %s' %
+                         (building, template))
+        if not self.test_error:
+            return
+        exists = self.sql_execute(
+            'sys', 'select 1 from pg_database where datname = %(name)s',
+            name=template)
+        self.sql_execute('sys', 'drop database if exists %s' % building)
+        if not exists:
+            raise Exception('Failed to rename template %s to %s' %
+                            (building, template))
+        self.log('green|Template %s is built by another run', template)
+
+    def cached_templates(self, db_name):
+        ''' Return {template: last_used} of templates built for db_name '''
+        rows = self.sql_execute(
+            'sys', cached_templates,
+            pattern='db_test template %s %%' % db_name) or []
+        return {r['datname']: int(r['descr'].rsplit(' ', 1)[1]) for r in rows}
+
+    def evict_templates(self, templates):
+        lru = sorted(templates, key=templates.get, reverse=True)
+        for template in lru[self.template_cache:]:
+            self.log('green|Dropping outdated template %s', template)
+            self.sql_execute('sys', 'drop database if exists %s' % template)
 
     def connect_db(self, db_name, ext_db_name, isolation_level=None):
+        self.prepared.pop(db_name, None)
         self.db_connections[db_name] = psycopg2.connect(
             dbname=ext_db_name,
             host=self.host,
@@ -145,27 +807,58 @@ class DBMS:
             if self.db_connections.get(db_name):
                 self.db_connections[db_name].close()
                 del self.db_connections[db_name]
+            if self.batch_connections.get(db_name):
+                self.batch_connections.pop(db_name).close()
+            if self.pools.get(db_name):
+                self.pools.pop(db_name).closeall()
 
     def sql_execute(self, db_name, query, **query_params):
+        return self.execute(db_name, query, query_params)
+
+    def sql_stream(self, db_name, query, consumer, query_params):
+        ''' Execute query by server-side cursor and feed rows to consumer
+
+        Rows are fetched and fed by chunks of self.itersize rows, so memory
+        does not depend on size of result. query has to be a single select.
+        '''
+        self.execute(db_name, query, query_params, consumer)
+
+    def execute(self, db_name, query, query_params, consumer=None):
         res = None
         con = None
+        started = time.time()
         self.test_error = False
         self.test_err_msg = None
         self.exception = None
         try:
             con = self.db_connections[db_name]
-            cur = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            if query_params:
+            if consumer is not None:
+                cur = con.cursor('db_test_stream',
+                                 cursor_factory=psycopg2.extras.RealDictCursor)
+            else:
+                cur = con.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            # savepoint of prepare() needs a transaction, so statements of
+            # autocommit connections (e.g. sys) are not prepared
+            if query_params and self.prepared_cache and consumer is None \
+                    and not con.autocommit:
+                self.execute_prepared(
+                    db_name, cur, query,
+                    dict(query_params, **self.global_params))
+            elif query_params:
                 cur.execute(query, dict(query_params, **self.global_params))
             else:
                 cur.execute(query)
-            if cur.rowcount > 0:
+            if consumer is not None:
+                for rows in iter(lambda: cur.fetchmany(self.itersize), []):
+                    consumer.feed(rows)
+            elif cur.rowcount > 0:
                 try:
                     res = [dict(r) for r in cur.fetchall()]
                 except psycopg2.ProgrammingError:
                     # catch error if execute return something on "insert"
                     pass
-            con.commit()
+            if not self.in_transaction:
+                con.commit()
         except (Exception, psycopg2.Error) as e:
             if con:
                 con.rollback()
@@ -182,15 +875,183 @@ class DBMS:
             self.exception = e
         finally:
             while con.notices:
-                self.log('yellow|    %s', con.notices.pop())
+                notice = con.notices.pop(0)
+                if self.explain_plans is not None and \
+                        explain.plan_re.match(notice):
+                    self.explain_plans.append(notice)
+                else:
+                    self.log('yellow|    %s', notice)
             cur.close()
+            self.duration = time.time() - started
         return res
 
+    def execute_prepared(self, db_name, cur, query, params):
+        ''' Execute query by prepared statement of the connection
+
+        Statements are cached by text of query, the least recently used are
+        deallocated when the cache is full. Statement whose result type was
+        changed by DDL is deallocated and the query is executed as usual.
+        '''
+        cache = self.prepared.setdefault(db_name, OrderedDict())
+        key = query
+        if key in cache:
+            cache.move_to_end(key)
+            statement = cache[key]
+            if statement:
+                self.prepared_hits += 1
+        else:
+            self.prepared_misses += 1
+            statement = self.prepare(cur, query)
+            cache[key] = statement
+            if len(cache) > self.prepared_cache:
+                evicted = cache.popitem(last=False)[1]
+                if evicted:
+                    cur.execute('deallocate %s' % evicted[0])
+
+        if not statement:
+            cur.execute(query, params)
+            return
+        execute = 'execute %s' % statement[0]
+        if statement[1]:
+            execute += '(%s)' % ', '.join('%%(%s)s' % p for p in statement[1])
+        if self.in_transaction:
+            # failed statement must not abort the whole transaction of test
+            execute = 'savepoint db_test_execute; ' + execute
+        try:
+            cur.execute(execute, params if statement[1] else None)
+        except psycopg2.Error as e:
+            # "cached plan must not change result type"
+            if e.pgcode != '0A000':
+                raise
+            if self.in_transaction:
+                cur.execute('rollback to savepoint db_test_execute')
+            else:
+                cur.connection.rollback()
+            del cache[key]
+            cur.execute('deallocate %s' % statement[0])
+            cur.execute(query, params)
+
+    def prepare(self, cur, query):
+        ''' Return (name, params) of prepared statement or None '''
+        converted = numeric_placeholders(query)
+        if converted is None:
+            return None
+        name = 'db_test_%s' % next(self.prepared_names)
+        try:
+            cur.execute('savepoint db_test_prepare;'
+                        'prepare %s as %s;'
+                        'release savepoint db_test_prepare' %
+                        (name, converted[0]))
+        except psycopg2.Error:
+            # e.g. type of parameter can not be determined
+            cur.execute('rollback to savepoint db_test_prepare;'
+                        'release savepoint db_test_prepare')
+            return None
+        return name, converted[1]
+
+    def fetch_batch(self, db_name, queries):
+        ''' Execute read only (query, params) in one pipeline
+
+        Returns list of results like sql_execute does or None if the batch
+        failed and queries have to be executed one by one.
+        '''
+        if db_name not in self.batch_connections:
+            self.batch_connections[db_name] = batch.connect(
+                dbname=self.ext_db_name(db_name),
+                host=self.host,
+                port=self.port,
+                user=self.username,
+                application_name=self.application_name)
+        return batch.fetch_batch(
+            self.batch_connections[db_name],
+            [(query, dict(params, **self.global_params) if params else None)
+             for query, params in queries])
+
+    def begin(self):
+        ''' Keep results of next statements in transaction until rollback '''
+        self.in_transaction = True
+
+    def rollback(self, db_name):
+        ''' Rollback everything done since begin() '''
+        self.in_transaction = False
+        con = self.db_connections.get(db_name)
+        if con:
+            con.rollback()
+
+    @contextmanager
+    def watchdog(self, db_name, timeout):
+        ''' Limit time of statements executed on db_name by timeout seconds
+
+        Every statement is limited by statement_timeout and lock_timeout,
+        the whole block is limited by the thread, which cancels the current
+        statement of the connection by pg_cancel_backend. Yields dict with
+        'fired': True when the thread has cancelled the statement.
+        '''
+        state = {'fired': False}
+        con = self.db_connections.get(db_name)
+        if not timeout or con is None:
+            yield state
+            return
+        ms = '%d' % (timeout * 1000)
+        self.sql_execute(db_name, "select set_config('statement_timeout', "
+                         "%(ms)s, false), set_config('lock_timeout', %(ms)s, "
+                         "false)", ms=ms)
+        pid = con.get_backend_pid()
+
+        def cancel():
+            state['fired'] = True
+            # not by sql_execute: it changes state of the running test
+            with self.db_connections['sys'].cursor() as cur:
+                cur.execute('select pg_cancel_backend(%s)', (pid,))
+
+        timer = threading.Timer(timeout, cancel)
+        timer.daemon = True
+        timer.start()
+        try:
+            yield state
+        finally:
+            timer.cancel()
+            # cancel() could start just before, its pg_cancel_backend may
+            # reach the server after the test and cancel the reset
+            timer.join()
+            for attempt in range(3):
+                self.sql_execute(db_name, 'reset statement_timeout; '
+                                 'reset lock_timeout')
+                if not self.timed_out():
+                    break
+
+    def timed_out(self):
+        ''' Last statement was cancelled by timeout '''
+        return (self.test_error and
+                getattr(self.exception, 'pgcode', None) in ('57014', '55P03'))
+
     def db_credentials(self):
-        ''' Returns list of createndials for connecting to Test DB '''
+        ''' Returns list of createndials for connecting to Test DB
+
+        dsns and pools (of pool_size connections, shared by all python
+        tests) are given by name of db.
+        '''
         data = {
             'host': self.host,
             'port': self.port,
-            'db_names': [self.ext_db_name(db_name) for db_name in self.dbs]
+            'db_names': [self.ext_db_name(db_name) for db_name in self.dbs],
+            'dsns': {db_name: self.dsn(db_name) for db_name in self.dbs},
+            'pools': {db_name: self.pool(db_name) for db_name in self.dbs},
         }
         return data
+
+    def dsn(self, db_name):
+        return psycopg2.extensions.make_dsn(
+            dbname=self.ext_db_name(db_name),
+            host=self.host,
+            port=self.port,
+            user=self.username,
+            application_name=self.application_name)
+
+    def pool(self, db_name):
+        ''' Pool of connections to db_name, created on first use '''
+        with self.pools_lock:
+            if db_name not in self.pools:
+                self.pools[db_name] = psycopg2.pool.ThreadedConnectionPool(
+                    0, self.pool_size, self.dsn(db_name))
+            return self.pools[db_name]
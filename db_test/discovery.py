@@ -0,0 +1,86 @@
+# -*- coding:utf-8 -*-
+import hashlib
+import os
+import pickle
+
+
+class DiscoveryCache:
+    ''' Test definitions of test modules, kept between runs
+
+    Module is identified by path, mtime and size of its file. Definitions
+    of unchanged modules are taken from cache without import, validated
+    (parent resolved) definitions are reused while no module is changed.
+    Modules with python tests and definitions which can not be pickled
+    (e.g. lambdas in params_generator) are imported as usual.
+    '''
+    def __init__(self, cache_dir, test_dir):
+        self.path = os.path.join(
+            cache_dir, 'discovery_%s.pickle' % hashlib.sha1(
+                os.path.abspath(test_dir).encode('utf-8')).hexdigest())
+        self.modules = {}
+        self.validated_key = None
+        self.validated_data = None
+        # key of every module found by this run
+        self.keys = {}
+        self.changed = False
+        try:
+            with open(self.path, 'rb') as f:
+                (self.modules, self.validated_key,
+                 self.validated_data) = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+    @staticmethod
+    def module_key(f_path):
+        st = os.stat(f_path)
+        return st.st_mtime_ns, st.st_size
+
+    def tests(self, f_path):
+        ''' Definitions of unchanged module or None '''
+        key = self.keys[f_path] = self.module_key(f_path)
+        entry = self.modules.get(f_path)
+        if entry is None or entry[0] != key:
+            return None
+        return pickle.loads(entry[1])
+
+    def put(self, f_path, tests):
+        ''' Store definitions of the module just imported '''
+        try:
+            data = pickle.dumps(tests)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            data = None
+        if data is None:
+            self.modules.pop(f_path, None)
+        else:
+            self.modules[f_path] = (self.keys[f_path], data)
+        self.changed = True
+
+    def validated(self):
+        ''' (correct tests, broken tests) if no module was changed '''
+        if self.validated_key != self.current_key():
+            return None
+        return pickle.loads(self.validated_data)
+
+    def put_validated(self, validated):
+        try:
+            self.validated_data = pickle.dumps(validated)
+            self.validated_key = self.current_key()
+        except (pickle.PicklingError, AttributeError, TypeError):
+            self.validated_key = self.validated_data = None
+        self.changed = True
+
+    def current_key(self):
+        return sorted(self.keys.items())
+
+    def save(self):
+        if not self.changed:
+            return
+        # forget removed modules
+        self.modules = {f_path: entry for f_path, entry in self.modules.items()
+                        if f_path in self.keys}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((self.modules, self.validated_key,
+                         self.validated_data), f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,64 @@
+# -*- coding:utf-8 -*-
+import json
+import re
+
+
+budget_keys = ('max_duration_ms', 'max_shared_buffers', 'forbid_seq_scan')
+
+# plans of top level statements are sent to client as notices
+enable = """
+    load 'auto_explain';
+    set auto_explain.log_min_duration = 0;
+    set auto_explain.log_analyze = on;
+    set auto_explain.log_buffers = on;
+    set auto_explain.log_format = json;
+    set auto_explain.log_level = notice;
+    set auto_explain.log_nested_statements = off"""
+
+disable = 'set auto_explain.log_min_duration = -1'
+
+plan_re = re.compile(r'^\w+:\s+duration: ([\d.]+) ms\s+plan:\s*(\{.*\})\s*$',
+                     re.S)
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def parse_notice(notice):
+    ''' (duration ms, plan) of auto_explain notice or None '''
+    match = plan_re.match(notice)
+    if match is None:
+        return None
+    return float(match.group(1)), json.loads(match.group(2))['Plan']
+
+
+def plan_stats(notices):
+    ''' Duration, shared buffers and seq scans of auto_explain notices '''
+    stats = {'duration_ms': 0, 'shared_buffers': 0, 'seq_scans': []}
+    for duration, top in filter(None, map(parse_notice, notices)):
+        stats['duration_ms'] += duration
+        stats['shared_buffers'] += (top.get('Shared Hit Blocks', 0) +
+                                    top.get('Shared Read Blocks', 0))
+        stats['seq_scans'].extend(node.get('Relation Name', '?')
+                                  for node in plan_nodes(top)
+                                  if node['Node Type'] == 'Seq Scan')
+    return stats
+
+
+def violations(data, stats):
+    ''' Budgets of test definition exceeded by the query '''
+    errs = []
+    if data.get('max_duration_ms') is not None and \
+            stats['duration_ms'] > data['max_duration_ms']:
+        errs.append('duration %.3f ms exceeds max_duration_ms %s' %
+                    (stats['duration_ms'], data['max_duration_ms']))
+    if data.get('max_shared_buffers') is not None and \
+            stats['shared_buffers'] > data['max_shared_buffers']:
+        errs.append('%s shared buffers exceed max_shared_buffers %s' %
+                    (stats['shared_buffers'], data['max_shared_buffers']))
+    if data.get('forbid_seq_scan') and stats['seq_scans']:
+        errs.append('seq scan on %s' % ', '.join(stats['seq_scans']))
+    return errs
@@ -0,0 +1,197 @@
+# -*- coding:utf-8 -*-
+import os
+import re
+import subprocess
+
+from db_test import loader
+
+
+object_dirs = {'tables', 'views', 'materializedviews', 'functions',
+               'procedures', 'types', 'sequences'}
+
+name = r'((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)'
+definition_res = [
+    re.compile(r'\bcreate\s+(?:or\s+replace\s+)?(?:unlogged\s+)?'
+               r'(?:materialized\s+)?'
+               r'(?:table|view|function|procedure|type|sequence)\s+'
+               r'(?:if\s+not\s+exists\s+)?' + name, re.I),
+    re.compile(r'\balter\s+table\s+(?:if\s+exists\s+)?(?:only\s+)?' + name,
+               re.I),
+    re.compile(r'\bcreate\s+(?:unique\s+)?index\b[^;]*?\bon\s+(?:only\s+)?' +
+               name, re.I),
+    re.compile(r'\bcreate\s+(?:constraint\s+)?trigger\b[^;]*?\bon\s+' + name,
+               re.I),
+]
+
+dependent_objects = """
+    with recursive objs(classid, objid) as (
+        select 'pg_class'::regclass::oid, c.oid
+          from pg_class c
+          join pg_namespace n on n.oid = c.relnamespace
+         where n.nspname || '.' || c.relname = any(%(names)s)
+        union
+        select 'pg_proc'::regclass::oid, p.oid
+          from pg_proc p
+          join pg_namespace n on n.oid = p.pronamespace
+         where n.nspname || '.' || p.proname = any(%(names)s)
+        union
+        -- views (by rules), tables (by triggers and defaults) and other
+        -- objects which depend on found ones
+        select dep.classid, dep.objid
+          from objs o
+          join lateral (
+            select case when d.classid = 'pg_proc'::regclass
+                        then d.classid
+                        else 'pg_class'::regclass::oid
+                   end as classid,
+                   case d.classid
+                     when 'pg_rewrite'::regclass then
+                       (select ev_class from pg_rewrite where oid = d.objid)
+                     when 'pg_trigger'::regclass then
+                       (select tgrelid from pg_trigger where oid = d.objid)
+                     when 'pg_attrdef'::regclass then
+                       (select adrelid from pg_attrdef where oid = d.objid)
+                     else d.objid
+                   end as objid
+              from pg_depend d
+             where d.refclassid = o.classid and
+                   d.refobjid = o.objid and
+                   d.classid in ('pg_rewrite'::regclass,
+                                 'pg_trigger'::regclass,
+                                 'pg_attrdef'::regclass,
+                                 'pg_class'::regclass,
+                                 'pg_proc'::regclass)
+          ) dep on true
+    )
+    select n.nspname || '.' || c.relname as name
+      from objs o
+      join pg_class c on c.oid = o.objid
+      join pg_namespace n on n.oid = c.relnamespace
+     where o.classid = 'pg_class'::regclass
+    union
+    select n.nspname || '.' || p.proname
+      from objs o
+      join pg_proc p on p.oid = o.objid
+      join pg_namespace n on n.oid = p.pronamespace
+     where o.classid = 'pg_proc'::regclass"""
+
+function_sources = """
+    select n.nspname || '.' || p.proname as name, p.prosrc
+      from pg_proc p
+      join pg_namespace n on n.oid = p.pronamespace
+     where n.nspname not in ('pg_catalog', 'information_schema')"""
+
+
+def normalize(obj_name):
+    ''' "Schema".name -> schema.name, public is the default schema '''
+    parts = [quoted or plain.lower()
+             for quoted, plain in re.findall(r'"([^"]+)"|(\w+)', obj_name)]
+    if len(parts) == 1:
+        parts.insert(0, 'public')
+    return '.'.join(parts)
+
+
+def changed_files(specs, dirs, log):
+    ''' Files from specs, every spec is a path or a git revision range
+
+    Git ranges are resolved in every directory of dirs, directories where
+    it fails (e.g. not a git repository) are reported by log. ValueError is
+    raised when the spec is resolved in none of them.
+    '''
+    files = []
+    for spec in specs:
+        if os.path.exists(spec):
+            if os.path.isdir(spec):
+                files.extend(os.path.join(root, f)
+                             for root, _, f_names in os.walk(spec)
+                             for f in f_names)
+            else:
+                files.append(spec)
+            continue
+        resolved = False
+        for directory in dirs:
+            out = subprocess.run(
+                ['git', '-C', directory, 'diff', '--name-only', '--relative',
+                 spec],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+            if out.returncode:
+                log('yellow|Can not get changes %s of %s: %s', spec,
+                    directory, out.stderr.strip())
+                continue
+            resolved = True
+            files.extend(os.path.join(directory, f)
+                         for f in out.stdout.split('\n') if f)
+        if not resolved:
+            raise ValueError("'%s' is neither a path nor a git revision "
+                             "range of %s" % (spec, ', '.join(dirs)))
+    return files
+
+
+def file_objects(f_path):
+    ''' Names of objects defined, altered or loaded by the file '''
+    names = set()
+    parts = os.path.normpath(f_path).split(os.sep)
+    # pg_export layout: .../<schema>/<kind>/<name>.sql
+    if len(parts) > 2 and parts[-2] in object_dirs:
+        names.add('%s.%s' % (parts[-3], os.path.splitext(parts[-1])[0]))
+    if not os.path.exists(f_path):
+        # removed file, only its path is known
+        return {normalize(n) for n in names}
+    with open(f_path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = loader.copy_re.match(line)
+            if match:
+                names.add(match.group(1))
+                # skip rows of data
+                for line in f:
+                    if line.rstrip('\r\n') == '\\.':
+                        break
+                continue
+            for definition_re in definition_res:
+                names.update(definition_re.findall(line))
+    return {normalize(n) for n in names}
+
+
+def affected_objects(dbms, names):
+    ''' Close names by dependencies in pg_depend and bodies of functions
+
+    plpgsql functions do not register dependencies on objects used in their
+    bodies, so functions which mention affected objects are added too.
+    '''
+    names = set(names)
+    if not names:
+        return names
+    sources = {db_name: dbms.sql_execute(db_name, function_sources) or []
+               for db_name in dbms.dbs}
+    while True:
+        found = set(names)
+        for db_name in dbms.dbs:
+            rows = dbms.sql_execute(db_name, dependent_objects,
+                                    names=sorted(found)) or []
+            found.update(r['name'] for r in rows)
+            found_re = name_re(found)
+            found.update(s['name'] for s in sources[db_name]
+                         if found_re.search(s['prosrc'] or ''))
+        if found == names:
+            return names
+        names = found
+
+
+def name_re(names):
+    ''' Regexp for any of names, objects of public also without schema '''
+    variants = set()
+    for obj_name in names:
+        schema, short = obj_name.split('.', 1)
+        variants.add(re.escape(obj_name))
+        if schema == 'public':
+            variants.add(re.escape(short))
+    return re.compile(r'(?<![\w.])(?:%s)\b' % '|'.join(sorted(variants)),
+                      re.I)
+
+
+def test_references(data, names_re):
+    ''' Test mentions affected objects in its queries '''
+    return any(names_re.search(data.get(key) or '')
+               for key in ('sql', 'check_sql', 'cleanup',
+                           'global_params_by_sql'))
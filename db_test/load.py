@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+from concurrent import futures
+import itertools
+import threading
+import time
+
+from db_test import bench
+
+
+# upper bounds of latency buckets, ms
+buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+           5000, float('inf'))
+
+# sqlstates counted separately, they are expected under contention
+contention_errors = {
+    '40001': 'serialization failure',
+    '40P01': 'deadlock',
+}
+
+histogram_width = 40
+
+
+class LoadGenerator:
+    ''' Load mode of TestRunner
+
+    sql of a test is run by `clients` sessions at once (own connection each)
+    for `duration` seconds or until `iterations` runs are done by all of
+    them. Every run is committed, so clients contend for the same data of
+    built database. params of the test are passed to its params_generator
+    (if any) before every run.
+    '''
+    def __init__(self, runner, clients, duration, iterations):
+        self.runner = runner
+        self.dbms = runner.dbms
+        self.log = runner.log
+        self.clients = clients
+        self.duration = duration
+        self.iterations = iterations
+
+    def run(self, t):
+        ''' Load db by the test, return number of unexpected errors '''
+        sessions = [self.dbms.session() for i in range(self.clients)]
+        tickets = itertools.count()
+        lock = threading.Lock()
+        deadline = time.time() + self.duration if self.duration else None
+
+        def next_run():
+            if deadline is not None:
+                return time.time() < deadline
+            with lock:
+                return next(tickets) < self.iterations
+
+        def client(session):
+            latencies = []
+            errors = {}
+            while next_run():
+                params = dict(t.data['params'])
+                if t.data.get('params_generator'):
+                    params = t.data['params_generator'](params)
+                session.sql_execute(t.data['db'], t.data['sql'],
+                                    **params, **t.plexor_connections())
+                if session.test_error:
+                    error = self.error_kind(session.exception)
+                    errors[error] = errors.get(error, 0) + 1
+                else:
+                    latencies.append(session.duration)
+            return latencies, errors
+
+        started = time.time()
+        try:
+            with futures.ThreadPoolExecutor(self.clients) as pool:
+                results = list(pool.map(client, sessions))
+        finally:
+            self.dbms.close_sessions()
+            self.dbms.sessions = []
+        elapsed = time.time() - started
+
+        latencies = [lat for client_lat, _ in results for lat in client_lat]
+        errors = {}
+        for _, client_errors in results:
+            for error, count in client_errors.items():
+                errors[error] = errors.get(error, 0) + count
+        self.report(t, elapsed, latencies, errors)
+        return sum(count for error, count in errors.items()
+                   if error not in contention_errors.values())
+
+    @staticmethod
+    def error_kind(exception):
+        pgcode = getattr(exception, 'pgcode', None)
+        if pgcode in contention_errors:
+            return contention_errors[pgcode]
+        return exception.__class__.__name__
+
+    def report(self, t, elapsed, latencies, errors):
+        runs = len(latencies) + sum(errors.values())
+        self.log('blue|  %s', t.name)
+        self.log('default|    %s runs by %s clients in %.3fs: %.1f tps, '
+                 '%s errors', runs, self.clients, elapsed,
+                 len(latencies) / elapsed if elapsed else 0,
+                 sum(errors.values()))
+        for error, count in sorted(errors.items()):
+            color = 'yellow|' if error in contention_errors.values() else \
+                'red|'
+            self.log('%s    %s: %s', color, error, count)
+        if not latencies:
+            return
+        stats = bench.summary(latencies)
+        self.log('default|    latency ms: min %.3f, p50 %.3f, p95 %.3f, '
+                 'p99 %.3f, max %.3f',
+                 *(stats[k] * 1000 for k in ('min', 'p50', 'p95', 'p99')),
+                 max(latencies) * 1000)
+        for bound, count in self.histogram(latencies):
+            self.log('default|    %9s ms %7s %s', '<= %g' % bound
+                     if bound != float('inf') else '> %g' % buckets[-2],
+                     count, '#' * round(
+                         histogram_width * count / len(latencies)))
+
+    @staticmethod
+    def histogram(latencies):
+        ''' (bucket bound, count) from the first to the last used bucket '''
+        counts = [0] * len(buckets)
+        for latency in latencies:
+            ms = latency * 1000
+            counts[next(i for i, b in enumerate(buckets) if ms <= b)] += 1
+        used = [i for i, count in enumerate(counts) if count]
+        return [(buckets[i], counts[i]) for i in range(used[0], used[-1] + 1)]
@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+import os
+import re
+
+
+copy_re = re.compile(
+    r'^\s*copy\s+(\S+?)\s*(?:\(.*\))?\s+from\s+stdin\s*;\s*$', re.I)
+buffer_size = 1 << 20
+
+
+class CopyBlock:
+    ''' File-like object with rows of one "copy ... from stdin" block
+
+    Reads rows from the data file up to the terminating "\\." line, so the
+    block is streamed into copy_expert without loading it into memory.
+    '''
+    def __init__(self, fp):
+        self.fp = fp
+        self.done = False
+
+    def read(self, size=-1):
+        chunks = []
+        length = 0
+        while not self.done and (size < 0 or length < size):
+            line = self.fp.readline()
+            if not line or line.rstrip('\r\n') == '\\.':
+                self.done = True
+                break
+            chunks.append(line)
+            length += len(line)
+        return ''.join(chunks)
+
+
+def data_files(paths):
+    ''' Return *.sql files from paths, the biggest first '''
+    files = []
+    for path in paths:
+        for root, dirs, f_names in os.walk(path):
+            files.extend(os.path.join(root, f)
+                         for f in f_names if f.endswith('.sql'))
+    return sorted(files, key=os.path.getsize, reverse=True)
+
+
+def load_file(con, f_name):
+    ''' Execute data file, "copy ... from stdin" blocks are sent by COPY '''
+    with open(f_name, encoding='utf-8') as fp, con.cursor() as cur:
+        statements = []
+        for line in iter(fp.readline, ''):
+            if copy_re.match(line):
+                if ''.join(statements).strip():
+                    cur.execute(''.join(statements))
+                statements = []
+                cur.copy_expert(line, CopyBlock(fp), size=buffer_size)
+            else:
+                statements.append(line)
+        if ''.join(statements).strip():
+            cur.execute(''.join(statements))
+    con.commit()
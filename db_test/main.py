@@ -1,15 +1,37 @@
+import atexit
+import signal
 import sys
 import os
 import argparse
+from db_test import aio
+from db_test import batch
+from db_test import cluster
 from db_test import runner
 
 
+def shard(value):
+    ''' "i/n" -> (i, n) '''
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard has to be i/n, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard i/n requires 1 <= i <= n")
+    return index, count
+
+
 def main():
     arg_parser = argparse.ArgumentParser(
         description='Run test',
         epilog='Report bugs to <a.chernyakov@comagic.dev>.',
         conflict_handler='resolve'
     )
+    arg_parser.add_argument('mode',
+                            nargs='?',
+                            choices=['test', 'bench', 'load'],
+                            default='test',
+                            help='run tests (default), benchmark sql of '
+                                 'tests or run it by concurrent clients')
     arg_parser.add_argument('-v', '--verbose',
                             action='store_true',
                             help='verbose message')
@@ -47,16 +69,289 @@ def main():
                             required=False,
                             action='store_true',
                             help='use docker or some other DB')
+    arg_parser.add_argument('--cluster',
+                            required=False,
+                            action='store_true',
+                            help='run tests on own throwaway cluster '
+                                 '(initdb, fsync=off) instead of -h/-p')
+    arg_parser.add_argument('--cluster-dir',
+                            required=False,
+                            metavar='DIR',
+                            help='parent of data directory of --cluster '
+                                 '(default: /dev/shm if available)')
+    arg_parser.add_argument('--cluster-init',
+                            required=False,
+                            metavar='FILE',
+                            help='sql executed in --cluster after start, '
+                                 'e.g. to create roles')
+    arg_parser.add_argument('--pg-bin',
+                            required=False,
+                            metavar='DIR',
+                            help='directory with initdb and pg_ctl for '
+                                 '--cluster (default: PATH or pg_config '
+                                 '--bindir)')
     arg_parser.add_argument('--range',
                             required=False,
                             action='append',
                             default=[],
                             help='--range=start_id:stop_id')
+    arg_parser.add_argument('--timeout',
+                            required=False,
+                            metavar='SECONDS',
+                            type=float,
+                            default=0,
+                            help='cancel test running longer than SECONDS '
+                                 '(0 - unlimited), see also key timeout of '
+                                 'test')
+    arg_parser.add_argument('--fail-fast',
+                            required=False,
+                            metavar='K',
+                            type=int,
+                            default=0,
+                            help='stop after K failed tests (0 - disabled)')
+    arg_parser.add_argument('--shard',
+                            required=False,
+                            metavar='I/N',
+                            type=shard,
+                            help='run only shard I of N, shards are balanced '
+                                 'by durations from --timings')
+    arg_parser.add_argument('--timings',
+                            required=False,
+                            metavar='FILE',
+                            dest='timings_file',
+                            help='JSON report (--json) of previous run with '
+                                 'durations of tests for --shard')
+    arg_parser.add_argument('--affected-by',
+                            required=False,
+                            metavar='PATH|GIT_RANGE',
+                            action='append',
+                            default=[],
+                            help='run only tests which use objects affected '
+                                 'by changed files or git range of DB_DIR '
+                                 'and TEST_DIR')
+    arg_parser.add_argument('--slowest',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=10,
+                            help='show N slowest tests (0 - disabled)')
+    arg_parser.add_argument('--json',
+                            required=False,
+                            metavar='FILE',
+                            dest='json_report',
+                            help='write timings of build and tests to FILE')
+    arg_parser.add_argument('--junit',
+                            required=False,
+                            metavar='FILE',
+                            dest='junit_report',
+                            help='write results and timings in JUnit XML '
+                                 'to FILE')
     arg_parser.add_argument('--db_name',
                             required=False,
                             help='fix name of database')
+    arg_parser.add_argument('-j', '--jobs',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=1,
+                            help='run db tests in N workers, each on its own '
+                                 'copy of database')
+    arg_parser.add_argument('--python-jobs',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=1,
+                            help='run python test classes in N threads')
+    arg_parser.add_argument('--pool-size',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=10,
+                            help='max connections of every pool given to '
+                                 'python tests by db_credentials')
+    arg_parser.add_argument('--load-jobs',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=0,
+                            help='load data by COPY in N parallel connections '
+                                 'instead of pg_import (0 - disabled)')
+    arg_parser.add_argument('--itersize',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=10000,
+                            help='rows fetched at once by tests with stream')
+    arg_parser.add_argument('--prepared-cache',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=0,
+                            help='execute queries of tests by prepared '
+                                 'statements, keep up to N of them per '
+                                 'connection (0 - disabled)')
+    arg_parser.add_argument('--batch',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=0,
+                            help='send up to N consecutive read only tests in '
+                                 'one pipeline (requires psycopg 3)')
+    arg_parser.add_argument('--rollback',
+                            required=False,
+                            action='store_true',
+                            help='run every test in transaction and rollback '
+                                 'it instead of commit and cleanup')
+    arg_parser.add_argument('--reuse',
+                            required=False,
+                            action='store_true',
+                            help='update database kept by previous run '
+                                 '(requires --db_name and --keep)')
+    arg_parser.add_argument('--cache-dir',
+                            required=False,
+                            default='~/.cache/db_test',
+                            help='directory for cached data of db_test')
+    arg_parser.add_argument('--discovery-cache',
+                            required=False,
+                            action='store_true',
+                            help='keep test definitions in --cache-dir, '
+                                 'import only changed test files')
+    arg_parser.add_argument('--async',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=0,
+                            dest='async_limit',
+                            help='run tests by asyncio engine, up to N tests '
+                                 'use every database at once (0 - disabled)')
+    arg_parser.add_argument('--fast-build',
+                            required=False,
+                            action='store_true',
+                            help='build db without synchronous commit, with '
+                                 'bigger maintenance_work_mem and single '
+                                 'analyze at the end')
+    arg_parser.add_argument('--unlogged',
+                            required=False,
+                            action='store_true',
+                            help='with --fast-build load data into unlogged '
+                                 'tables')
+    arg_parser.add_argument('--build-maintenance-work-mem',
+                            required=False,
+                            metavar='SIZE',
+                            default='1GB',
+                            help='maintenance_work_mem of --fast-build')
+    arg_parser.add_argument('--snapshot-cache',
+                            required=False,
+                            action='store_true',
+                            help='keep dump of built db in --cache-dir and '
+                                 'restore it by pg_restore instead of build')
+    arg_parser.add_argument('--restore-jobs',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=os.cpu_count() or 1,
+                            help='jobs of pg_dump and pg_restore for '
+                                 '--snapshot-cache (default: number of CPUs)')
+    arg_parser.add_argument('--template-cache',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=0,
+                            help='keep up to N built template databases per '
+                                 'db and clone test db from them '
+                                 '(0 - disabled)')
+    arg_parser.add_argument('--iterations',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=100,
+                            help='measured runs of every test in bench '
+                                 'mode, runs by all clients in load mode')
+    arg_parser.add_argument('--clients',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=10,
+                            help='concurrent connections in load mode')
+    arg_parser.add_argument('--duration',
+                            required=False,
+                            metavar='SECONDS',
+                            type=float,
+                            default=0,
+                            help='run load for SECONDS instead of '
+                                 '--iterations runs')
+    arg_parser.add_argument('--warmup',
+                            required=False,
+                            metavar='N',
+                            type=int,
+                            default=10,
+                            help='unmeasured runs of every test before '
+                                 'iterations in bench mode')
+    arg_parser.add_argument('--baseline',
+                            required=False,
+                            metavar='FILE',
+                            help='compare bench results with FILE, write '
+                                 'them to FILE if it does not exist')
+    arg_parser.add_argument('--update-baseline',
+                            required=False,
+                            action='store_true',
+                            help='write bench results to --baseline FILE')
+    arg_parser.add_argument('--bench-threshold',
+                            required=False,
+                            metavar='PERCENT',
+                            type=float,
+                            default=10,
+                            help='report regression when test is slower than '
+                                 'baseline by PERCENT and the difference is '
+                                 'significant')
 
     args = arg_parser.parse_args()
+    args.bench_threshold /= 100
+
+    if args.reuse and not (args.db_name and args.keep):
+        arg_parser.error("--reuse requires --db_name and --keep")
+
+    if args.async_limit and (args.jobs > 1 or args.batch):
+        arg_parser.error("--async can not be used with -j or --batch")
+
+    if args.mode != 'test' and (args.jobs > 1 or args.async_limit):
+        arg_parser.error("%s can not be used with -j or --async" % args.mode)
+
+    if args.clients < 1 or args.duration < 0:
+        arg_parser.error("--clients must be positive, --duration must not "
+                         "be negative")
+
+    if args.iterations < 1 or args.warmup < 0:
+        arg_parser.error("--iterations must be positive, --warmup must not "
+                         "be negative")
+
+    for name in ('jobs', 'python_jobs', 'pool_size', 'itersize',
+                 'restore_jobs'):
+        if getattr(args, name) < 1:
+            arg_parser.error("--%s must be positive" % name.replace('_', '-'))
+
+    # 0 disables these options
+    for name in ('load_jobs', 'template_cache', 'prepared_cache', 'batch',
+                 'timeout', 'fail_fast', 'slowest', 'bench_threshold',
+                 'async_limit'):
+        if getattr(args, name) < 0:
+            arg_parser.error("--%s must not be negative" %
+                             name.replace('_', '-'))
+
+    if args.cluster and (args.host or args.port or args.keep):
+        arg_parser.error("--cluster can not be used with -h, -p or -k")
+
+    if args.unlogged and not args.fast_build:
+        arg_parser.error("--unlogged requires --fast-build")
+
+    if args.update_baseline and not args.baseline:
+        arg_parser.error("--update-baseline requires --baseline")
+
+    if args.batch and batch.psycopg is None:
+        arg_parser.error("--batch requires psycopg 3 (pip install psycopg)")
+
+    if args.async_limit and aio.psycopg is None:
+        arg_parser.error("--async requires psycopg 3 (pip install psycopg)")
 
     for d in args.db_dirs:
         d = d.split(':')[1]
@@ -66,8 +361,33 @@ def main():
     if not os.path.exists(os.path.expanduser(args.test_dir)):
         arg_parser.error("can not access to test_dir '%s'" % args.test_dir)
 
+    if args.cluster:
+        c = cluster.EphemeralCluster(
+            runner.ProcessMixin().log,
+            args.username or os.environ.get('PGUSER', 'postgres'),
+            base_dir=args.cluster_dir, bin_dir=args.pg_bin,
+            init_sql=args.cluster_init)
+        # registered before clean_all of runner, so it is called after it
+        atexit.register(c.stop)
+
+        def stop_cluster(signum, frame):
+            c.stop()
+            # without atexit: threads of tests may wait for the removed
+            # cluster and there is nothing to clean in it
+            os._exit(128 + signum)
+
+        # CI sends SIGTERM on timeout or cancel
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, stop_cluster)
+        c.start()
+        args.host, args.port = c.host, c.port
+
     r = runner.TestRunner(args)
     r.load_tests()
     r.prepare_db()
+    if args.mode == 'bench':
+        sys.exit(r.run_bench())
+    if args.mode == 'load':
+        sys.exit(r.run_load())
     sys.exit(r.run_tests())
 #   clean_all do automaticaly on exit
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+import json
+import re
+from xml.etree import ElementTree
+
+
+color_re = re.compile(r'(red|yellow|green|blue|default)\|')
+
+
+def strip_colors(message):
+    return color_re.sub('', message).strip()
+
+
+def status(result):
+    if result.startswith('green| Passed'):
+        return 'passed'
+    if result.startswith('yellow|'):
+        return 'skipped'
+    return 'failed'
+
+
+def slowest(results, count):
+    ''' count of (test, result) with the longest duration '''
+    return sorted(results, key=lambda r: r[0].duration, reverse=True)[:count]
+
+
+def write_json(f_name, phases, results):
+    data = {
+        'build': [
+            {'db': db_name, 'phase': phase, 'duration': round(duration, 6)}
+            for db_name, phase, duration in phases
+        ],
+        'tests': [
+            {
+                'id': t.data['id'],
+                'name': t.name,
+                'db': t.data.get('db'),
+                'status': status(result),
+                'duration': round(t.duration, 6),
+                'timings': {k: round(v, 6) for k, v in t.timings.items()},
+            }
+            for t, result in results
+        ],
+        'duration': round(sum(t.duration for t, _ in results), 6),
+    }
+    with open(f_name, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+
+
+def read_durations(f_name):
+    ''' Durations of tests by id from JSON report of previous run '''
+    with open(f_name) as f:
+        data = json.load(f)
+    return {t['id']: t['duration'] for t in data.get('tests', [])}
+
+
+def write_junit(f_name, phases, results):
+    ''' JUnit XML with suites "build" (phases of build) and "db_test" '''
+    root = ElementTree.Element('testsuites')
+
+    build = ElementTree.SubElement(
+        root, 'testsuite', name='build', tests=str(len(phases)),
+        failures='0', skipped='0',
+        time='%.6f' % sum(p[2] for p in phases if p[1] == 'total'))
+    for db_name, phase, duration in phases:
+        ElementTree.SubElement(build, 'testcase', classname=db_name,
+                               name=phase, time='%.6f' % duration)
+
+    statuses = [status(result) for _, result in results]
+    suite = ElementTree.SubElement(
+        root, 'testsuite', name='db_test', tests=str(len(results)),
+        failures=str(statuses.count('failed')),
+        skipped=str(statuses.count('skipped')),
+        time='%.6f' % sum(t.duration for t, _ in results))
+    for (t, result), test_status in zip(results, statuses):
+        case = ElementTree.SubElement(
+            suite, 'testcase', classname=str(t.data.get('db')), name=t.name,
+            time='%.6f' % t.duration)
+        if t.timings:
+            properties = ElementTree.SubElement(case, 'properties')
+            for statement, duration in t.timings.items():
+                ElementTree.SubElement(properties, 'property',
+                                       name=statement + '_time',
+                                       value='%.6f' % duration)
+        if test_status == 'failed':
+            failure = ElementTree.SubElement(case, 'failure',
+                                             message='Failed')
+            failure.text = strip_colors(result)
+        elif test_status == 'skipped':
+            ElementTree.SubElement(case, 'skipped',
+                                   message=strip_colors(result))
+
+    ElementTree.ElementTree(root).write(f_name, encoding='utf-8',
+                                        xml_declaration=True)
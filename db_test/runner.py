@@ -1,12 +1,22 @@
 # -*- coding:utf-8 -*-
 import atexit
+from concurrent import futures
 from functools import reduce
 import importlib
 import inspect
 import os
+import re
 import sys
+import threading
+import time
 
 from db_test import adapter
+from db_test import aio
+from db_test import bench
+from db_test import discovery
+from db_test import impact
+from db_test import load
+from db_test import report
 from db_test import tests as tts
 from db_test import validator
 from db_test.dbms import DBMS
@@ -20,6 +30,8 @@ colors = {
     'default|': '\033[0m'
 }
 
+param_re = re.compile(r'%\((\w+)\)s')
+
 
 class ProcessMixin:
     def log(self, message, *args):
@@ -35,13 +47,47 @@ class TestRunner(ProcessMixin):
         self.verbose = args.verbose
         self.keep = args.keep
         self.break_on_test = args.break_on_test
+        self.jobs = args.jobs
+        self.batch = args.batch
+        self.async_limit = args.async_limit
+        self.affected_by = args.affected_by
+        self.affected_re = None
+        # ids of tests defined in files changed by --affected-by
+        self.changed_tests = set()
+        # path of test file -> ids of tests defined in it
+        self.test_files = {}
+        self.slowest = args.slowest
+        self.json_report = args.json_report
+        self.junit_report = args.junit_report
+        self.iterations = args.iterations
+        self.warmup = args.warmup
+        self.baseline = args.baseline
+        self.update_baseline = args.update_baseline
+        self.bench_threshold = args.bench_threshold
+        self.clients = args.clients
+        self.shard = args.shard
+        self.fail_fast = args.fail_fast
+        self.python_jobs = args.python_jobs
+        # failures counted by all workers for --fail-fast
+        self.fast_failures = 0
+        self.fail_lock = threading.Lock()
+        self.timings_file = args.timings_file
+        self.duration = args.duration
+        # (test, result) of runned db tests
+        self.results = []
         self.dbms = DBMS(self.log, args)
+        self.discovery = None
+        if args.discovery_cache:
+            self.discovery = discovery.DiscoveryCache(self.dbms.cache_dir,
+                                                      self.test_dir)
 
         # All tests in one variable
         self.tests = []
         # Separate variable for runned tests
         self.validated_tests = []
         self.exts = {}
+        # id of test -> id of its parent, before validator resolves them
+        self.parents = {}
         self.python_tests = []
         self.python_validated_tests = []
         self.failed_count = 0
@@ -57,10 +103,11 @@ class TestRunner(ProcessMixin):
         if not self.keep:
             atexit.register(self.dbms.clean_all)
         self.dbms.build_db()
+        if self.jobs > 1:
+            self.dbms.clone(self.jobs)
 
-    def run_tests(self):
-        if self.validated_tests:
-            self.log('green|Run DB tests:')
+    def selected_tests(self):
+        tests = []
         for t in self.validated_tests:
             if t.data['id'] == self.break_on_test:
                 self.log('green|break on <%s>', self.break_on_test)
@@ -68,13 +115,253 @@ class TestRunner(ProcessMixin):
             if self.id_ranges and \
                     not any(t.data['id'] in r for r in self.id_ranges):
                 continue
-            result = t.run()
+            if self.affected_re and not self.in_changed_file(t) and \
+                    not impact.test_references(t.data, self.affected_re):
+                continue
+            tests.append(t)
+        if self.shard:
+            tests = self.shard_tests(tests)
+        return tests
+
+    def shard_tests(self, tests):
+        ''' Tests of shard i of n, shards are balanced by durations
+
+        Groups of dependent tests (see test_groups) are not split. Durations
+        are taken from JSON report of previous run (--timings), tests
+        missing in it take the mean duration. Without durations groups are
+        distributed round-robin.
+        '''
+        groups = sorted(self.test_groups(tests),
+                        key=lambda g: min(t.data['id'] for t in g))
+        shard_tests = self.shard_groups(
+            [([t.data['id'] for t in g], g) for g in groups], 'tests')
+        selected = {id(t) for t in shard_tests}
+        return [t for t in tests if id(t) in selected]
+
+    def shard_python_tests(self, python_tests):
+        ''' Python test classes of shard i of n, classes are not split '''
+        groups = sorted(
+            ((['%s.%s' % (pt.plugin_class.__name__, name)
+               for name, _ in pt.test_methods()], [pt])
+             for pt in python_tests), key=lambda g: g[0])
+        selected = {id(pt) for pt in
+                    self.shard_groups(groups, 'python test classes')}
+        return [pt for pt in python_tests if id(pt) in selected]
+
+    def shard_groups(self, groups, kind):
+        ''' Items of shard i of n from (ids of tests, items) of groups '''
+        index, count = self.shard
+        durations = {}
+        if self.timings_file and os.path.exists(self.timings_file):
+            durations = report.read_durations(self.timings_file)
+        known = [durations[i] for ids, _ in groups for i in ids
+                 if i in durations]
+        if known:
+            default = sum(known) / len(known)
+            loads = [0] * count
+            shards = [[] for i in range(count)]
+            weighted = [(sum(durations.get(i, default) for i in ids), n, items)
+                        for n, (ids, items) in enumerate(groups)]
+            # the longest groups first, each to the least loaded shard
+            for duration, n, items in sorted(weighted,
+                                             key=lambda w: (-w[0], w[1])):
+                shard = loads.index(min(loads))
+                loads[shard] += duration
+                shards[shard].extend(items)
+            shard_items = shards[index - 1]
+            self.log('green|Shard %s/%s: %s %s, about %.3fs', index, count,
+                     len(shard_items), kind, loads[index - 1])
+        else:
+            shard_items = [item for n, (ids, items) in enumerate(groups)
+                           if n % count == index - 1 for item in items]
+            self.log('green|Shard %s/%s: %s %s (round-robin)', index, count,
+                     len(shard_items), kind)
+        return shard_items
+
+    def find_affected(self):
+        ''' Objects affected by changes given by --affected-by '''
+        dirs = [os.path.expanduser(d.split(':', 1)[1]) for d in self.db_dirs] + \
+            [os.path.expanduser(self.test_dir)]
+        try:
+            files = impact.changed_files(self.affected_by, dirs, self.log)
+        except ValueError as e:
+            self.log('red|  Error: %s', e)
+            sys.exit(2)
+        names = set()
+        for f_path in files:
+            f_path = os.path.abspath(f_path)
+            if f_path in self.test_files:
+                self.changed_tests.update(self.test_files[f_path])
+            else:
+                names.update(impact.file_objects(f_path))
+        affected = impact.affected_objects(self.dbms, names)
+        self.log('green|%s changed objects affect %s objects, %s tests are '
+                 'changed', len(names), len(affected),
+                 len(self.changed_tests))
+        # nothing is affected - no test is selected by objects
+        self.affected_re = impact.name_re(affected) if affected else \
+            re.compile(r'(?!)')
+
+    def in_changed_file(self, t):
+        ''' Test or some of its parents is defined in changed test file '''
+        test_id = t.data['id']
+        seen = set()
+        while test_id is not None and test_id not in seen:
+            if test_id in self.changed_tests:
+                return True
+            seen.add(test_id)
+            test_id = self.parents.get(test_id)
+        return False
+
+    def test_groups(self, tests):
+        ''' Split tests into groups which have to run on the same worker
+
+        Tests of one parent chain share the same group, as well as tests
+        with global_params_by_sql and tests which use params missing in
+        their own definition (i.e. global params).
+        '''
+        groups = {}
+        for t in tests:
+            test_id = t.data['id']
+            seen = set()
+            while self.parents.get(test_id) in self.parents and \
+                    test_id not in seen:
+                seen.add(test_id)
+                test_id = self.parents[test_id]
+            if t.data.get('global_params_by_sql') or self.uses_global_params(t):
+                test_id = 'global_params'
+            groups.setdefault(test_id, []).append(t)
+        return list(groups.values())
+
+    def uses_global_params(self, t):
+        for key in ('sql', 'check_sql', 'cleanup'):
+            for param in param_re.findall(t.data.get(key) or ''):
+                if param not in t.data['params'] and \
+                        not param.startswith('plexor_connection_'):
+                    return True
+        return False
+
+    def run_parallel(self, tests):
+        ''' Run tests on worker databases, return results in tests order '''
+        order = {id(t): i for i, t in enumerate(tests)}
+        queues = [[] for w in self.dbms.workers]
+        for group in sorted(self.test_groups(tests), key=len, reverse=True):
+            min(queues, key=len).extend(group)
+
+        def run_queue(worker, queue):
+            queue = sorted(queue, key=lambda t: order[id(t)])
+            # every test is run by only one worker
+            for t in queue:
+                t.dbms = worker
+            results = self.run_sequence(queue)
+            return [(order[id(t)], result)
+                    for t, result in zip(queue, results)]
+
+        results = [None] * len(tests)
+        with futures.ThreadPoolExecutor(len(queues)) as pool:
+            for res in pool.map(run_queue, self.dbms.workers, queues):
+                for i, result in res:
+                    results[i] = result
+        return results
+
+    def run_sequence(self, tests):
+        ''' Run tests one by one and yield their results
+
+        With --fail-fast K no test is started after K failures of all
+        workers, results of tests which are not run are not yielded.
+        '''
+        results = self._run_sequence(tests)
+        while not self.stopped():
+            result = next(results, None)
+            if result is None:
+                return
+            if self.fail_fast and not result.startswith('green| Passed'):
+                with self.fail_lock:
+                    self.fast_failures += 1
+            yield result
+
+    def stopped(self):
+        return bool(self.fail_fast) and self.fast_failures >= self.fail_fast
+
+    def _run_sequence(self, tests):
+        ''' Run tests one by one and yield their results
+
+        With --batch N up to N consecutive read only tests of the same db are
+        sent in one pipeline. Failed tests of a batch are run again as usual,
+        so they are reported exactly as without batch.
+        '''
+        queue = []
+        for t in tests:
+            if queue and (not t.batchable() or len(queue) >= self.batch or
+                          t.data['db'] != queue[0].data['db']):
+                yield from self.run_batch(queue)
+                queue = []
+            if self.batch and t.batchable():
+                queue.append(t)
+            else:
+                yield t.run()
+        yield from self.run_batch(queue)
+
+    def run_batch(self, tests):
+        if not tests:
+            return
+        started = time.time()
+        results = tests[0].dbms.fetch_batch(
+            tests[0].data['db'],
+            [(t.data['sql'], dict(t.data['params'], **t.plexor_connections()))
+             for t in tests])
+        # duration of the batch is shared by its tests
+        duration = (time.time() - started) / len(tests)
+        for i, t in enumerate(tests):
+            result = None
+            if results is not None:
+                result = t.check_result(results[i], t.comparator())
+                t.duration = duration
+                t.timings = {'sql': duration}
+            if result != 'green| Passed':
+                result = t.run()
+            yield result
+
+    def run_tests(self):
+        if self.validated_tests:
+            self.log('green|Run DB tests:')
+        if self.affected_by:
+            self.find_affected()
+        tests = self.selected_tests()
+        if self.affected_by:
+            self.log('green|%s of %s tests are affected', len(tests),
+                     len(self.validated_tests))
+        if self.async_limit:
+            results = aio.AsyncEngine(self, self.async_limit).run_db_tests(
+                tests)
+        elif self.dbms.workers:
+            results = self.run_parallel(tests)
+        else:
+            results = self.run_sequence(tests)
+        for t, result in zip(tests, results):
+            if result is None:
+                # not run by --fail-fast
+                continue
+            self.results.append((t, result))
             self.failed_count += int(not result.startswith('green| Passed'))
             if self.verbose or result.startswith('green| Passed'):
                 self.log("blue|  %s %s", t.name, result)
             else:
                 self.log("blue|  %s| red| Failed", t.name)
 
+        if self.stopped():
+            self.log("red|stopped after %s failures, %s tests are not run",
+                     self.fail_fast, len(tests) - len(self.results))
+
+        if self.dbms.prepared_cache:
+            dbmss = [self.dbms] + self.dbms.workers + self.dbms.sessions
+            self.log("green|prepared statements: %s hits, %s misses",
+                     sum(d.prepared_hits for d in dbmss),
+                     sum(d.prepared_misses for d in dbmss))
+
+        if not self.stopped():
+            self.run_python_tests()
+
         if self.failed_count != 0:
             self.log("red|%s tests failed", self.failed_count)
             if not self.verbose:
@@ -82,20 +369,167 @@ class TestRunner(ProcessMixin):
         else:
             self.log("green|all tests passed")
 
-        if self.python_validated_tests:
+        self.report()
+        return int(self.failed_count != 0)
+
+    def run_python_tests(self):
+        python_tests = self.python_validated_tests
+        if python_tests:
             self.log('green|Run python-DB tests:')
-        for pt in self.python_validated_tests:
-            pt.run()
+        if python_tests and self.shard:
+            python_tests = self.shard_python_tests(python_tests)
+        if self.async_limit:
+            results = aio.AsyncEngine(self, self.async_limit).run_python_tests(
+                python_tests)
+        else:
+            results = self.run_python_classes(python_tests)
+        for class_results in results:
+            for case, result in class_results:
+                self.results.append((case, result))
+                self.failed_count += int(
+                    not result.startswith('green| Passed'))
+                self.log("blue|  %s %s", case.name, result)
+
+    def run_python_classes(self, python_tests):
+        ''' Results of python test classes in their order
+
+        With --python-jobs N classes are run in N threads, except classes
+        with "parallel = False", which are run one by one after them.
+        '''
+        results = [None] * len(python_tests)
+        parallel = [i for i, pt in enumerate(python_tests)
+                    if self.python_jobs > 1 and pt.parallel()]
+        if parallel:
+            with futures.ThreadPoolExecutor(self.python_jobs) as pool:
+                for i, res in zip(parallel, pool.map(
+                        lambda i: python_tests[i].run(), parallel)):
+                    results[i] = res
+        for i, pt in enumerate(python_tests):
+            if results[i] is None:
+                results[i] = pt.run()
+        return results
+
+    def run_bench(self):
+        ''' Benchmark sql of selected tests
+
+        Every test is run as usual first, so it is checked against the data
+        it is written for and its global params are available to the
+        following tests. Then sql of passed test is run `warmup` times and
+        `iterations` times in transaction, which is rolled back, so all runs
+        see the same data. Sequences are not rolled back, so they are set
+        back after the runs.
+        '''
+        if self.affected_by:
+            self.find_affected()
+        baseline = bench.load_baseline(self.baseline) if self.baseline else {}
+        stats = {}
+        regressions = 0
+        self.log('green|Benchmark DB tests (%s warmup, %s iterations):',
+                 self.warmup, self.iterations)
+        self.log('blue|  %11s %11s %11s %11s %11s  %s',
+                 'min', 'p50', 'p95', 'p99', 'stddev', 'test')
+        for t in self.selected_tests():
+            result = t.run()
+            if not result.startswith('green| Passed'):
+                self.failed_count += 1
+                self.log('blue|  %s red| Failed', t.name)
+                if self.verbose:
+                    self.log('%s', result)
+                continue
+            samples = self.bench_test(t)
+            if samples is None:
+                continue
+            stats[t.name] = bench.summary(samples)
+            self.log('blue|  %s  default|%s', ' '.join(
+                '%9.3fms' % (stats[t.name][k] * 1000)
+                for k in ('min', 'p50', 'p95', 'p99', 'stddev')), t.name)
+            if t.name in baseline:
+                slowdown = bench.regression(baseline[t.name], stats[t.name],
+                                            self.bench_threshold)
+                if slowdown is not None:
+                    regressions += 1
+                    self.log('red|    %.1f%% slower than baseline (p50 '
+                             '%.3fms)', slowdown * 100,
+                             baseline[t.name]['p50'] * 1000)
+
+        if self.baseline and (self.update_baseline or not baseline):
+            bench.save_baseline(self.baseline, dict(baseline, **stats))
+            self.log('green|baseline saved to %s', self.baseline)
+        if regressions:
+            self.log('red|%s tests regressed', regressions)
+        if self.failed_count:
+            self.log('red|%s tests failed', self.failed_count)
+        return int(bool(regressions or self.failed_count))
+
+    def bench_test(self, t):
+        ''' Latencies of sql of the test or None if it can't be measured '''
+        if 'sql' not in t.data or t.data.get('expected_exception') or \
+                t.data['db'] not in self.dbms.db_connections:
+            return None
+        params = dict(t.data['params'], **t.plexor_connections())
+        seqs = self.dbms.sequence_values(t.data['db'])
+        samples = []
+        try:
+            for i in range(self.warmup + self.iterations):
+                self.dbms.begin()
+                try:
+                    self.dbms.sql_execute(t.data['db'], t.data['sql'],
+                                          **params)
+                finally:
+                    self.dbms.rollback(t.data['db'])
+                if self.dbms.test_error:
+                    return None
+                if i >= self.warmup:
+                    samples.append(self.dbms.duration)
+        finally:
+            self.dbms.reset_sequences(t.data['db'], seqs)
+        return samples
+
+    def run_load(self):
+        ''' Run sql of every selected test by concurrent clients '''
+        if self.affected_by:
+            self.find_affected()
+        generator = load.LoadGenerator(self, self.clients, self.duration,
+                                       self.iterations)
+        self.log('green|Load DB by tests:')
+        for t in self.selected_tests():
+            if t.data['db'] not in self.dbms.db_connections:
+                self.log('blue|  %s yellow| There is no target DB %s. '
+                         'Skipped.', t.name, t.data['db'])
+                continue
+            self.failed_count += int(generator.run(t) > 0)
+        if self.failed_count:
+            self.log('red|%s tests failed with unexpected errors',
+                     self.failed_count)
         return int(self.failed_count != 0)
 
+    def report(self):
+        if self.slowest and self.results:
+            self.log('green|Slowest tests:')
+            for t, result in report.slowest(self.results, self.slowest):
+                self.log('blue|  %8.3fs %s', t.duration, t.name)
+        if self.json_report:
+            report.write_json(self.json_report, self.dbms.phases, self.results)
+        if self.junit_report:
+            report.write_junit(self.junit_report, self.dbms.phases,
+                               self.results)
+
     def validate_tests(self):
         if not self.tests and not self.python_tests:
             self.log("red|  There is no available tests. "
                      "Execution is canceled")
             sys.exit(2)
 
-        _validator = validator.Validator(self.tests)
-        ok_tests, failed_tests = _validator.validate()
+        self.parents = {t['id']: t.get('parent') for t in self.tests}
+        validated = self.discovery.validated() if self.discovery else None
+        if validated is None:
+            _validator = validator.Validator(self.tests)
+            validated = _validator.validate()
+            if self.discovery:
+                self.discovery.put_validated(validated)
+        if self.discovery:
+            self.discovery.save()
+        ok_tests, failed_tests = validated
         for t_name, errs in failed_tests:
             errs_msg = '\n - '.join(errs)
             self.log("%s red|:\n - %s" % (t_name, errs_msg))
@@ -125,6 +559,28 @@ class TestRunner(ProcessMixin):
         self._import_db_tests(test_file)
         self._import_python_tests(test_file)
 
+    def discover_tests(self, directory_name, file_name, f_path):
+        ''' Load tests of file and remember which tests it defines '''
+        tests_count = len(self.tests)
+        self._discover_tests(directory_name, file_name, f_path)
+        self.test_files[os.path.abspath(f_path)] = [
+            t['id'] for t in self.tests[tests_count:]]
+
+    def _discover_tests(self, directory_name, file_name, f_path):
+        ''' Take tests of unchanged file from cache or import it '''
+        if self.discovery is None:
+            return self.import_tests(directory_name, file_name)
+        tests = self.discovery.tests(f_path)
+        if tests is not None:
+            self.tests.extend(tests)
+            return
+        tests_count = len(self.tests)
+        python_tests_count = len(self.python_tests)
+        self.import_tests(directory_name, file_name)
+        # python tests can't be taken without import
+        if len(self.python_tests) == python_tests_count:
+            self.discovery.put(f_path, self.tests[tests_count:])
+
     def _import_db_tests(self, test_file):
         ''' Load db_tests from imported file '''
         if hasattr(test_file, 'tests'):
@@ -150,5 +606,5 @@ class TestRunner(ProcessMixin):
                     self.log("red|  Failed to parse file name %s: %s" %
                              (f_name, e))
                 if ext == 'py':
-                    self.import_tests(root, f_name)
+                    self.discover_tests(root, f_name, os.path.join(root, f))
         self.validate_tests()
@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+import hashlib
+import os
+import re
+
+from db_test import loader
+
+
+function_dirs = {'functions', 'procedures'}
+view_dirs = {'views'}
+
+function_re = re.compile(
+    r'\bcreate\s+(?:or\s+replace\s+)?(?:function|procedure)\s+'
+    r'((?:"[^"]+"|[\w.])+)\s*\(', re.I)
+
+
+def walk_files(path):
+    ''' Yield (relative path, path) of files under path in stable order '''
+    for root, dirs, files in os.walk(path):
+        # skip hidden directories (.git, .hg, etc.)
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for f in sorted(files):
+            f_path = os.path.join(root, f)
+            yield os.path.relpath(f_path, path), f_path
+
+
+def dir_fingerprint(hasher, path):
+    ''' Update hasher with names and contents of all files under path '''
+    for rel_path, f_path in walk_files(path):
+        hasher.update(rel_path.encode('utf-8'))
+        with open(f_path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 16), b''):
+                hasher.update(chunk)
+
+
+def function_signatures(text):
+    ''' Normalized "name(arguments)" of functions created by text '''
+    signatures = []
+    for match in function_re.finditer(text):
+        depth = 1
+        pos = match.end()
+        # arguments end by the matching parenthesis (types like numeric(p, s)
+        # and defaults contain their own ones)
+        while depth and pos < len(text):
+            depth += {'(': 1, ')': -1}.get(text[pos], 0)
+            pos += 1
+        args = ' '.join(text[match.end():pos - 1].split()).lower()
+        signatures.append('%s(%s)' % (match.group(1).lower(), args))
+    return sorted(signatures)
+
+
+def file_manifest(f_path, data=False, function=False):
+    ''' Return [sha1, tables] of file
+
+    tables are filled for data files, signatures of functions are given
+    instead of them for function files.
+    '''
+    hasher = hashlib.sha1()
+    tables = []
+    with open(f_path, 'rb') as fp:
+        if data:
+            for line in fp:
+                hasher.update(line)
+                if line[:5].lower() == b'copy ':
+                    match = loader.copy_re.match(line.decode('utf-8'))
+                    if match:
+                        tables.append(match.group(1))
+        elif function:
+            text = fp.read()
+            hasher.update(text)
+            tables = function_signatures(text.decode('utf-8', 'replace'))
+        else:
+            for chunk in iter(lambda: fp.read(1 << 16), b''):
+                hasher.update(chunk)
+    return [hasher.hexdigest(), tables]
+
+
+def source_kind(key):
+    ''' Kind of pg_export file: data, function, view or schema '''
+    parts = key.split(os.sep)
+    if parts[0] == 'test-data' or parts[1] == 'data':
+        return 'data'
+    if function_dirs.intersection(parts):
+        return 'function'
+    if view_dirs.intersection(parts):
+        return 'view'
+    return 'schema'
+
+
+def source_manifest(sources):
+    ''' Return {key: [sha1, tables]} of files of sources {prefix: path} '''
+    manifest = {}
+    for prefix, path in sources.items():
+        for rel_path, f_path in walk_files(path):
+            key = os.path.join(prefix, rel_path)
+            manifest[key] = file_manifest(f_path,
+                                          source_kind(key) == 'data',
+                                          source_kind(key) == 'function')
+    return manifest
@@ -1,7 +1,12 @@
 import inspect
 import re
+import time
 import datadiff
 
+from db_test import batch
+from db_test import compare
+from db_test import explain
+
 
 class DBTest:
     def __init__(self, name, data, dbms):
@@ -9,27 +14,177 @@ class DBTest:
         self.name = name
         self.data = data
         self.data['params'] = self.data.get('params') or {}
+        # duration of the whole test and of its statements
+        self.duration = 0
+        self.timings = {}
+        # auto_explain notices of sql for performance budgets
+        self.sql_plans = None
 
     def run(self):
-        result = self._run()
+        started = time.time()
+        self.timings = {}
+        timeout = self.timeout()
+        try:
+            with self.dbms.watchdog(self.data['db'], timeout) as watchdog:
+                explain_error = self.start_explain()
+                result = self._run_with_cleanup()
+                timed_out = watchdog['fired'] or self.dbms.timed_out()
+                budget_errs = self.check_budgets(explain_error)
+            if timed_out and not result.startswith('green| Passed'):
+                result = "red| Timed out after %ss\n%s" % (timeout, result)
+            elif budget_errs and result.startswith('green| Passed'):
+                result = ("red| Failed on performance budget\n"
+                          "yellow|    %s" % '\n    '.join(budget_errs))
+            return result
+        finally:
+            self.duration = time.time() - started
+
+    async def arun(self):
+        ''' Like run, but by coroutines of aio.AsyncSession in self.dbms '''
+        started = time.time()
+        self.timings = {}
+        timeout = self.timeout()
+        try:
+            async with self.dbms.watchdog(self.data['db'], timeout) \
+                    as watchdog:
+                result = await self.adrive(self.steps_with_cleanup())
+                timed_out = watchdog['fired'] or self.dbms.timed_out()
+            if timed_out and not result.startswith('green| Passed'):
+                result = "red| Timed out after %ss\n%s" % (timeout, result)
+            return result
+        finally:
+            self.duration = time.time() - started
+
+    def async_runnable(self):
+        ''' Test can be run by aio.AsyncEngine
+
+        Streamed results and plans of performance budgets are got by
+        blocking DBMS only.
+        '''
+        return (self.data['db'] in self.dbms.db_connections and
+                not self.data.get('stream') and
+                not self.has_budgets())
+
+    def timeout(self):
+        ''' Seconds given to the test, 0 - unlimited '''
+        if self.data.get('timeout') is not None:
+            return self.data['timeout']
+        return self.dbms.timeout
+
+    def has_budgets(self):
+        return (any(self.data.get(k) is not None
+                    for k in explain.budget_keys) and
+                not self.data.get('expected_exception') and
+                self.data['db'] in self.dbms.db_connections)
+
+    def start_explain(self):
+        ''' Log plans of the next statements by auto_explain
+
+        Plans are collected while the test runs, so sql is not executed
+        once more. Returns error if auto_explain can not be loaded.
+        '''
+        self.sql_plans = None
+        if not self.has_budgets():
+            return None
+        self.dbms.sql_execute(self.data['db'], explain.enable)
+        if self.dbms.test_error:
+            return 'auto_explain can not be loaded: %s' % self.dbms.exception
+        self.dbms.explain_plans = []
+        return None
+
+    def check_budgets(self, explain_error):
+        ''' Check plans of sql logged by auto_explain against budgets
+
+        Only plan of sql itself is checked, queries inside of functions are
+        not logged (log_nested_statements is off).
+        '''
+        if not self.has_budgets():
+            return []
+        if explain_error:
+            return [explain_error]
+        self.dbms.explain_plans = None
+        self.dbms.sql_execute(self.data['db'], explain.disable)
+        if not self.sql_plans:
+            return ['plan of sql is not logged by auto_explain']
+        return explain.violations(self.data,
+                                  explain.plan_stats(self.sql_plans))
+
+    def _run_with_cleanup(self):
+        return self.drive(self.steps_with_cleanup())
+
+    def steps_with_cleanup(self):
+        ''' Steps (see steps) of the test with its cleanup or rollback '''
+        if self.isolated() and self.data['db'] in self.dbms.db_connections:
+            # nextval is not rolled back, sequences are set back after test
+            seqs = yield self.dbms.sequence_values(self.data['db'])
+            self.dbms.begin()
+            try:
+                return (yield from self.steps())
+            finally:
+                yield self.dbms.rollback(self.data['db'])
+                yield self.dbms.reset_sequences(self.data['db'], seqs)
+
+        result = yield from self.steps()
         # Run cleanup only if main logic is success, i.e. result is Success
         if self.data.get('cleanup') and 'green' in result:
             kwargs = {
                 'db_name': self.data['db'],
                 'query': self.data['cleanup']
             }
-            self.dbms.sql_execute(**kwargs)
+            yield self.dbms.sql_execute(**kwargs)
+            self.timings['cleanup'] = self.dbms.duration
             if self.dbms.test_error:
                 result = ("red| Cleanup failed\n%s" % self.dbms.test_err_msg)
         return result
 
-    def _run(self):
-        if self.data['db'] not in self.dbms.db_connections:
-            return ("yellow| There is no target DB for testing - %s. "
-                    "Available DB names are: %s. Skipped." %
-                    (self.data['db'], self.dbms.db_connections.keys()))
+    @staticmethod
+    def drive(steps):
+        ''' Result of steps executed by blocking DBMS '''
+        try:
+            value = next(steps)
+            while True:
+                value = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
 
-        plexor_connections = {
+    @staticmethod
+    async def adrive(steps):
+        ''' Result of steps executed by session of aio.AsyncEngine '''
+        try:
+            value = next(steps)
+            while True:
+                try:
+                    if inspect.isawaitable(value):
+                        value = await value
+                except Exception as e:
+                    value = steps.throw(e)
+                else:
+                    value = steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+
+    def isolated(self):
+        ''' Test runs in transaction which is rolled back instead of cleanup
+
+        Tests with global_params_by_sql are committed, because the following
+        tests can use data created by them.
+        '''
+        return (self.dbms.isolation and
+                not self.data.get('commit') and
+                not self.data.get('global_params_by_sql'))
+
+    def batchable(self):
+        ''' Test only reads data by single select and checks its result '''
+        return (self.data['db'] in self.dbms.db_connections and
+                batch.is_read_only(self.data.get('sql', '')) and
+                not any(self.data.get(k) for k in (
+                    'check_sql', 'global_params_by_sql', 'cleanup',
+                    'expected_exception', 'stream', 'commit') +
+                    explain.budget_keys) and
+                not self.timeout())
+
+    def plexor_connections(self):
+        return {
             'plexor_connection_' + db_name: (
                 f'dbname={self.dbms.ext_db_name(db_name)} '
                 f'host={self.dbms.host} port={self.dbms.port}'
@@ -37,13 +192,51 @@ class DBTest:
             for db_name in self.dbms.dbs
         }
 
+    def comparator(self):
+        return compare.ResultComparator(
+            self.data['result'],
+            ordered=self.data.get('ordered', True),
+            digest=self.data.get('result_hash'))
+
+    def steps(self):
+        ''' Run the test by statements of self.dbms, return result
+
+        Generator: every call of self.dbms which executes a statement is
+        yielded and its result is sent back, so the same steps are run by
+        blocking DBMS (drive) and by coroutines of aio.AsyncSession (adrive).
+        '''
+        if self.data['db'] not in self.dbms.db_connections:
+            return ("yellow| There is no target DB for testing - %s. "
+                    "Available DB names are: %s. Skipped." %
+                    (self.data['db'], self.dbms.db_connections.keys()))
+
+        plexor_connections = self.plexor_connections()
+        comparator = self.comparator()
+        # result of the last query is streamed to comparator by chunks
+        stream = (self.data.get('stream') and
+                  not self.data.get('expected_exception'))
+
         if 'sql' in self.data:
-            res = self.dbms.sql_execute(
-                self.data['db'],
-                self.data['sql'],
-                **self.data['params'],
-                **plexor_connections,
-            )
+            if self.dbms.explain_plans is not None:
+                # plans of statements before sql (e.g. sequence_values)
+                self.dbms.explain_plans.clear()
+            if stream and not self.data.get('check_sql'):
+                res = yield self.dbms.sql_stream(
+                    self.data['db'],
+                    self.data['sql'],
+                    comparator,
+                    dict(self.data['params'], **plexor_connections),
+                )
+            else:
+                res = yield self.dbms.sql_execute(
+                    self.data['db'],
+                    self.data['sql'],
+                    **self.data['params'],
+                    **plexor_connections,
+                )
+            self.timings['sql'] = self.dbms.duration
+            if self.dbms.explain_plans is not None:
+                self.sql_plans = list(self.dbms.explain_plans)
             if self.dbms.test_error:
                 if not self.data.get('expected_exception'):
                     return "red| Failed\n%s" % self.dbms.test_err_msg
@@ -63,41 +256,62 @@ class DBTest:
                             '\n     '.join(self.dbms.test_err_msg.split('\n')))
 
         if self.data.get('global_params_by_sql'):
-            params = self.dbms.sql_execute(
+            params = yield self.dbms.sql_execute(
                 self.data['db'],
                 self.data['global_params_by_sql'],
                 **self.data['params']
             )
+            self.timings['global_params_by_sql'] = self.dbms.duration
             if self.dbms.test_error:
                 return "red| Failed on global_params_by_sql\n%s" % self.dbms.test_err_msg
             if params:
                 self.dbms.global_params.update(params[0])
 
-        if self.data.get('check_sql'):
-            res = self.dbms.sql_execute(
+        if self.data.get('check_sql') and stream:
+            res = yield self.dbms.sql_stream(
+                self.data['db'],
+                self.data['check_sql'],
+                comparator,
+                self.data['params'],
+            )
+        elif self.data.get('check_sql'):
+            res = yield self.dbms.sql_execute(
                 self.data['db'],
                 self.data['check_sql'],
                 **self.data['params']
             )
+        if self.data.get('check_sql'):
+            self.timings['check_sql'] = self.dbms.duration
             if self.dbms.test_error:
                 return "red| Failed on check_sql\n%s" % self.dbms.test_err_msg
 
         if self.data.get('expected_exception'):
             expected_res = 'expected_exception: ' + \
                            self.data['expected_exception']
-        else:
-            expected_res = self.data['result']
+            if res == expected_res:
+                return "green| Passed"
+            return self.failed_message(expected_res, res)
+
+        return self.check_result(res, comparator, stream)
 
-        if res == expected_res:
+    def check_result(self, res, comparator, stream=False):
+        if not stream:
+            comparator.feed(res)
+        if comparator.equal():
             return "green| Passed"
-        else:
-            return (f"red| Failed\n"
-                    f"yellow|    expected result:\n"
-                    f"default|      {expected_res}\n"
-                    f"yellow|    does not match actual:\n"
-                    f"default|      {res}\n"
-                    f"yellow|    diff:\n"
-                    f"default|{self.diff_strings(expected_res, res)}")
+        if not stream and comparator.ordered and not comparator.digest and \
+                len(res or []) <= compare.max_diff_rows * 10:
+            return self.failed_message(self.data['result'], res)
+        return "red| Failed\n%s" % comparator.diff()
+
+    def failed_message(self, expected_res, res):
+        return (f"red| Failed\n"
+                f"yellow|    expected result:\n"
+                f"default|      {expected_res}\n"
+                f"yellow|    does not match actual:\n"
+                f"default|      {res}\n"
+                f"yellow|    diff:\n"
+                f"default|{self.diff_strings(expected_res, res)}")
 
     def match_expected_exception(self):
         return (
@@ -122,29 +336,90 @@ class DBTest:
             return str(e)
 
 
+class PythonTestCase:
+    ''' Test method of python tests, reported as DBTest '''
+    def __init__(self, plugin_class, method_name):
+        self.name = '%s.%s' % (plugin_class.__name__, method_name)
+        self.data = {'id': self.name, 'db': None}
+        self.duration = 0
+        self.timings = {}
+
+
 class PythonTests:
     def __init__(self, plugin_class, dbms, log):
         self.plugin_class = plugin_class
         self.dbms = dbms
         self.log = log
 
-    def run(self):
+    def parallel(self):
+        ''' Class can be run concurrently with other classes '''
+        return getattr(self.plugin_class, 'parallel', True)
+
+    def test_methods(self):
         tests = [
             t for t in inspect.getmembers(self.plugin_class,
                                           predicate=inspect.isfunction)
             if t[0].startswith('test_')]
         # sort tests by name
-        tests = sorted(tests, key=lambda t: t[0])
+        return sorted(tests, key=lambda t: t[0])
+
+    def run(self):
+        ''' Run test methods, return list of (PythonTestCase, result) '''
+        tests = self.test_methods()
         creds = self.dbms.db_credentials()
         try:
             db_class = self.plugin_class(creds)
+            init = getattr(db_class, '_init_coro', None)
+            if init:
+                if inspect.iscoroutine(init):
+                    init.close()
+                raise AssertionError(
+                    'coroutine init_db is not awaited, use --async N')
         except Exception as e:
-            for test in tests:
-                self.log("blue|  %s red| Failed\n %s" % (test[0], e))
-        else:
-            for test in tests:
-                try:
-                    test[1](db_class)
-                    self.log("blue|  %s green| Passed" % test[0])
-                except Exception as e:
-                    self.log("blue|  %s red| Failed\n %s" % (test[0], e))
+            return self.failed_init(tests, e)
+        results = []
+        for test in tests:
+            case = PythonTestCase(self.plugin_class, test[0])
+            started = time.time()
+            try:
+                res = test[1](db_class)
+                if inspect.iscoroutine(res):
+                    res.close()
+                    raise AssertionError(
+                        'coroutine test is not awaited, use --async N')
+                result = "green| Passed"
+            except Exception as e:
+                result = "red| Failed\n %s" % e
+            case.duration = time.time() - started
+            results.append((case, result))
+        return results
+
+    async def arun(self):
+        ''' Like run, but "async def" init_db and test methods are awaited '''
+        tests = self.test_methods()
+        creds = self.dbms.db_credentials()
+        try:
+            db_class = self.plugin_class(creds)
+            if getattr(db_class, '_init_coro', None):
+                await db_class._init_coro
+        except Exception as e:
+            return self.failed_init(tests, e)
+        results = []
+        for test in tests:
+            case = PythonTestCase(self.plugin_class, test[0])
+            started = time.time()
+            try:
+                res = test[1](db_class)
+                if inspect.isawaitable(res):
+                    await res
+                result = "green| Passed"
+            except Exception as e:
+                result = "red| Failed\n %s" % e
+            case.duration = time.time() - started
+            results.append((case, result))
+        return results
+
+    def failed_init(self, tests, e):
+        return [(PythonTestCase(self.plugin_class, test[0]),
+                 "red| Failed\n %s" % e)
+                for test in tests]
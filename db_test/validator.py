@@ -1,6 +1,3 @@
-import copy
-
-
 class TestKey:
     def __init__(self, name, _type=str, required=False, check=None):
         self.name = name
@@ -19,12 +16,21 @@ schema = [
     TestKey('name', required=True),
     TestKey('sql', required=True),
     TestKey('result', required=True, _type='any'),
+    TestKey('ordered', _type=bool),
+    TestKey('result_hash'),
+    TestKey('stream', _type=bool),
     TestKey('db', required=True),
     TestKey('check_sql'),
     TestKey('global_params_by_sql'),
     TestKey('parent', check='parent_check', _type='any'),
     TestKey('params', _type=dict, check='params_check'),
+    TestKey('params_generator', _type='any', check='params_generator_check'),
     TestKey('cleanup'),
+    TestKey('commit', _type=bool),
+    TestKey('max_duration_ms', _type=(int, float)),
+    TestKey('max_shared_buffers', _type=int),
+    TestKey('forbid_seq_scan', _type=bool),
+    TestKey('timeout', _type=(int, float)),
     TestKey('expected_exception', check='expected_exception_check'),
     TestKey('description'),
 ]
@@ -37,6 +43,7 @@ class Validator:
             raise Exception("There are name duplications in tests defintions")
         self.correct_tests = []
         self.broken_tests = []
+        self.resolved, self.parent_errors = self.resolve_parents()
 
     def validate(self):
         ''' Validate test schema definition '''
@@ -47,7 +54,7 @@ class Validator:
             if errs:
                 self.broken_tests.append((name, errs))
             else:
-                self.correct_tests.append((name, self.tests[test_id]))
+                self.correct_tests.append((name, self.resolved[test_id]))
 
         return self.correct_tests, self.broken_tests
 
@@ -89,7 +96,7 @@ class Validator:
         return errs
 
     def params_check(self, name, data, errs):
-        params = self.tests[data['id']].get('params')
+        params = self.resolved.get(data['id'], data).get('params')
         if 'sql' in data:
             try:
                 data['sql'] % params
@@ -99,29 +106,75 @@ class Validator:
                 )
 
     def parent_check(self, name, data, errs):
-        parent = data.get('parent')
-        if parent in self.tests:
-            # hidden update test according parent link
-            if 'parent' in self.tests[parent]:
-                self.parent_check(parent, self.tests[parent], errs)
-            new_data = copy.deepcopy(self.tests[parent])
-            # remove parent for resolved test
-            data.pop('parent')
-            params = None
-            if 'params' in new_data or 'params' in data:
-                params = dict(new_data.get('params', {}),
-                              **data.get('params', {}))
-            new_data.update(data)
+        if data['id'] in self.parent_errors:
+            errs.append(self.parent_errors[data['id']])
+
+    def resolve_parents(self):
+        ''' Merge every test with its parents
+
+        Tests are resolved from the root of the parent chain down to the
+        test and every resolved test is kept, so each of them is merged only
+        once. Definitions of tests are not changed, resolved tests share
+        values (e.g. result) with their parents.
+
+        Returns resolved tests and errors of tests with broken chains.
+        '''
+        resolved = {}
+        errors = {}
+        for test_id in self.tests:
+            chain = []
+            current = test_id
+            # go up to resolved (or broken) test or root of the chain
+            while current not in resolved and current not in errors:
+                if current in chain:
+                    loop = chain[chain.index(current):] + [current]
+                    for loop_id in loop:
+                        errors[loop_id] = "Parent loop: %s" % ' -> '.join(
+                            str(i) for i in loop)
+                    break
+                chain.append(current)
+                if 'parent' not in self.tests[current]:
+                    break
+                parent = self.tests[current]['parent']
+                if parent not in self.tests:
+                    errors[current] = (
+                        "Parent - '%s' is not presented in list of tests." %
+                        parent)
+                    break
+                current = parent
+            for chain_id in reversed(chain):
+                if chain_id in resolved or chain_id in errors:
+                    continue
+                data = self.tests[chain_id]
+                if 'parent' not in data:
+                    resolved[chain_id] = data
+                elif data['parent'] in errors:
+                    errors[chain_id] = errors[data['parent']]
+                else:
+                    resolved[chain_id] = self.merge(
+                        resolved[data['parent']], data)
+        return resolved, errors
+
+    @staticmethod
+    def merge(parent_data, data):
+        ''' Test inherited from resolved parent, params are merged '''
+        new_data = dict(parent_data)
+        new_data.update(data)
+        # remove parent for resolved test
+        new_data.pop('parent')
+        if 'params' in parent_data or 'params' in data:
+            params = dict(parent_data.get('params', {}),
+                          **data.get('params', {}))
             if params:
-                new_data.update({'params': params})
-            self.tests[data['id']] = new_data
-        else:
-            errs.append(
-                "Parent - '%s' is not presented in list of tests." % parent
-            )
+                new_data['params'] = params
+        return new_data
+
+    def params_generator_check(self, name, data, errs):
+        if not callable(data['params_generator']):
+            errs.append("params_generator has to be callable")
 
     def expected_exception_check(self, name, data, errs):
-        actual_data = self.tests[data['id']]
+        actual_data = self.resolved.get(data['id'], data)
         if actual_data.get('expected_exception') and \
            actual_data.get('check_sql'):
             errs.append(
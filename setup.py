@@ -46,6 +46,13 @@ install_requires = [
 ]
 
 
+# Необязательные зависимости
+extras_require = {
+    'batch': ['psycopg>=3.1'],
+    'async': ['psycopg>=3.1'],
+}
+
+
 # Что нужно для запуска python setup.py test
 tests_require = [
     'flake8>=4,<5',
@@ -95,6 +102,7 @@ setup(
     python_requires='>=3.5',
     setup_requires=setup_requires,
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=tests_require,
     cmdclass={'test': PyTest},
 )
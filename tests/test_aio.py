@@ -0,0 +1,157 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+
+import pytest
+
+pytest.importorskip('datadiff')
+pytest.importorskip('psycopg2')
+pytest.importorskip('pg_import')
+
+from db_test import aio  # noqa: E402
+from db_test import runner  # noqa: E402
+from db_test import tests as tts  # noqa: E402
+
+
+class FakeDBMS:
+    ''' DBMS of one db, results of queries are given by their text '''
+    def __init__(self, results, isolation=False):
+        self.results = results
+        self.isolation = isolation
+        self.timeout = 0
+        self.db_connections = {'db': None}
+        self.dbs = {}
+        self.global_params = {}
+        self.explain_plans = None
+        self.test_error = False
+        self.test_err_msg = None
+        self.exception = None
+        self.duration = 0
+        self.calls = []
+
+    def sql_execute(self, db_name, query, **params):
+        self.calls.append(query)
+        return self.results.get(query)
+
+    def begin(self):
+        self.calls.append('begin')
+
+    def rollback(self, db_name):
+        self.calls.append('rollback')
+
+    def sequence_values(self, db_name):
+        self.calls.append('sequence_values')
+        return []
+
+    def reset_sequences(self, db_name, seqs):
+        self.calls.append('reset_sequences')
+
+    @contextmanager
+    def watchdog(self, db_name, timeout):
+        yield {'fired': False}
+
+    def timed_out(self):
+        return False
+
+
+class FakeSession(FakeDBMS):
+    ''' FakeDBMS with coroutines as aio.AsyncSession '''
+    async def sql_execute(self, db_name, query, **params):
+        await asyncio.sleep(0)
+        return FakeDBMS.sql_execute(self, db_name, query, **params)
+
+    async def rollback(self, db_name):
+        FakeDBMS.rollback(self, db_name)
+
+    async def sequence_values(self, db_name):
+        return FakeDBMS.sequence_values(self, db_name)
+
+    async def reset_sequences(self, db_name, seqs):
+        FakeDBMS.reset_sequences(self, db_name, seqs)
+
+    @asynccontextmanager
+    async def watchdog(self, db_name, timeout):
+        yield {'fired': False}
+
+    async def close(self):
+        pass
+
+
+def make_test(test_id, dbms, **data):
+    return tts.DBTest('%s. test' % test_id, dict(
+        {'id': test_id, 'db': 'db', 'sql': 'select %s' % test_id,
+         'result': [{'a': test_id}]}, **data), dbms)
+
+
+results = {
+    'select 1': [{'a': 1}],
+    'select token': [{'token': 't'}],
+    'check': [{'a': 1}],
+}
+
+
+@pytest.mark.parametrize('dbms_class', [FakeDBMS, FakeSession])
+def test_steps(dbms_class):
+    dbms = dbms_class(results)
+    t = make_test(1, dbms, check_sql='check',
+                  global_params_by_sql='select token', cleanup='cleanup')
+    if dbms_class is FakeDBMS:
+        result = t.run()
+    else:
+        result = asyncio.run(t.arun())
+    assert result == 'green| Passed'
+    assert dbms.calls == ['select 1', 'select token', 'check', 'cleanup']
+    assert dbms.global_params == {'token': 't'}
+    assert set(t.timings) == {'sql', 'global_params_by_sql', 'check_sql',
+                              'cleanup'}
+
+
+@pytest.mark.parametrize('dbms_class', [FakeDBMS, FakeSession])
+def test_steps_isolated(dbms_class):
+    dbms = dbms_class(results, isolation=True)
+    t = make_test(1, dbms, result=[{'a': 2}])
+    if dbms_class is FakeDBMS:
+        result = t.run()
+    else:
+        result = asyncio.run(t.arun())
+    assert result.startswith('red| Failed')
+    assert dbms.calls == ['sequence_values', 'begin', 'select 1',
+                          'rollback', 'reset_sequences']
+
+
+def test_engine(monkeypatch):
+    base = FakeDBMS(results)
+    base.dbs = {'db': '~/db'}
+    running = []
+    peak = []
+    done = []
+
+    class Session(FakeSession):
+        async def sql_execute(self, db_name, query, **params):
+            if query == 'select 2':
+                assert 'select 1' in done
+            running.append(query)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(query)
+            done.append(query)
+            return {'select %s' % i: [{'a': i}] for i in range(10)}[query]
+
+    async def connect(base, db_name):
+        return Session(results)
+
+    monkeypatch.setattr(aio.AsyncSession, 'connect', connect)
+    test_runner = runner.TestRunner.__new__(runner.TestRunner)
+    test_runner.dbms = base
+    test_runner.fail_fast = 0
+    test_runner.fast_failures = 0
+    # 2 -> 1 is a parent chain, 2 is started after 1
+    test_runner.parents = {i: None for i in range(10)}
+    test_runner.parents[2] = 1
+    all_tests = [make_test(i, base) for i in range(10)]
+    all_tests[3].data['result'] = []
+
+    res = aio.AsyncEngine(test_runner, 3).run_db_tests(all_tests)
+    assert [r.startswith('green| Passed') for r in res] == \
+        [i != 3 for i in range(10)]
+    assert max(peak) == 3
+    assert all(t.dbms is base for t in all_tests)
@@ -0,0 +1,14 @@
+from db_test import batch
+
+
+def test_is_read_only():
+    assert batch.is_read_only('select 1')
+    assert batch.is_read_only('  WITH x AS (select 1) select * from x;\n')
+    assert batch.is_read_only('values (1), (2)')
+
+
+def test_is_read_only_modifying():
+    assert not batch.is_read_only('insert into t values (1)')
+    assert not batch.is_read_only('update t set a = 1')
+    assert not batch.is_read_only('select 1; delete from t')
+    assert not batch.is_read_only('selection')
@@ -0,0 +1,44 @@
+import pytest
+
+from db_test import bench
+
+
+def test_percentile():
+    samples = [1, 2, 3, 4, 5]
+    assert bench.percentile(samples, 0) == 1
+    assert bench.percentile(samples, 50) == 3
+    assert bench.percentile(samples, 100) == 5
+    assert bench.percentile(samples, 90) == pytest.approx(4.6)
+    assert bench.percentile([7], 99) == 7
+
+
+def test_summary():
+    stats = bench.summary([3, 1, 2])
+    assert stats['n'] == 3
+    assert stats['min'] == 1
+    assert stats['p50'] == 2
+    assert stats['mean'] == 2
+    assert stats['stddev'] == 1
+    assert bench.summary([5])['stddev'] == 0
+
+
+def stats(mean, stddev=0.001, n=100):
+    return {'mean': mean, 'stddev': stddev, 'n': n}
+
+
+def test_regression():
+    assert bench.regression(stats(1), stats(1.5), 0.1) == pytest.approx(0.5)
+
+
+def test_regression_below_threshold():
+    assert bench.regression(stats(1), stats(1.05), 0.1) is None
+    assert bench.regression(stats(1), stats(0.5), 0.1) is None
+
+
+def test_regression_not_significant():
+    # slower by 50% on average, but samples are too noisy
+    assert bench.regression(stats(1, 5, 10), stats(1.5, 5, 10), 0.1) is None
+
+
+def test_regression_zero_base():
+    assert bench.regression(stats(0), stats(1), 0.1) is None
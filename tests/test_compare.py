@@ -0,0 +1,89 @@
+from db_test.compare import ResultComparator
+
+
+def compare(expected, rows, **kwargs):
+    comparator = ResultComparator(expected, **kwargs)
+    for chunk in rows:
+        comparator.feed(chunk)
+    return comparator
+
+
+def test_ordered():
+    rows = [{'a': 1}, {'a': 2}]
+    assert compare(rows, [rows[:1], rows[1:]]).equal()
+    assert not compare(rows, [rows[::-1]]).equal()
+    assert not compare(rows, [rows[:1]]).equal()
+
+
+def test_unordered():
+    expected = [{'a': 1}, {'a': 2}, {'a': 2}]
+    assert compare(expected, [[{'a': 2}], [{'a': 1}, {'a': 2}]],
+                   ordered=False).equal()
+    # multiset, not set
+    assert not compare(expected, [[{'a': 1}, {'a': 2}]],
+                       ordered=False).equal()
+    assert not compare(expected, [[{'a': 1}, {'a': 2}, {'a': 1}]],
+                       ordered=False).equal()
+
+
+def test_unordered_diff():
+    comparator = compare([{'a': 1}, {'a': 2}], [[{'a': 2}, {'a': 3}]],
+                         ordered=False)
+    assert not comparator.equal()
+    diff = comparator.diff()
+    assert 'missing rows (1)' in diff
+    assert "{'a': 1}" in diff
+    assert 'unexpected rows (1)' in diff
+    assert "{'a': 3}" in diff
+
+
+def test_unordered_nested_values():
+    expected = [{'a': [1, {'b': 2}]}, {'a': None}]
+    assert compare(expected, [expected[::-1]], ordered=False).equal()
+
+
+def digest(rows, ordered):
+    comparator = compare(None, [rows], ordered=ordered, digest='-')
+    return comparator.actual_digest()
+
+
+def test_digest():
+    rows = [{'a': 1}, {'a': 2}]
+    ordered = digest(rows, True)
+    assert ordered.startswith('2:')
+    assert compare(None, [rows[:1], rows[1:]], digest=ordered).equal()
+    assert not compare(None, [rows[::-1]], digest=ordered).equal()
+
+
+def test_unordered_digest():
+    rows = [{'a': 1}, {'a': 2}, {'a': 2}]
+    unordered = digest(rows, False)
+    assert unordered != digest(rows, True)
+    assert compare(None, [rows[::-1]], ordered=False,
+                   digest=unordered).equal()
+    assert not compare(None, [rows[:2]], ordered=False,
+                       digest=unordered).equal()
+    assert unordered in compare(None, [rows], ordered=False,
+                                digest='0:0').diff()
+
+
+def test_no_result():
+    assert compare(None, [None]).equal()
+    assert not compare(None, [[]]).equal()
+    assert not compare([], [None]).equal()
+    assert compare([], [[]]).equal()
+
+
+def test_digest_of_bytea():
+    # psycopg2 returns bytea as memoryview, whose repr has its address
+    rows = [{'a': memoryview(b'\x00\x01'), 'b': 1}]
+    same = [{'b': 1, 'a': memoryview(bytearray(b'\x00\x01'))}]
+    for ordered in (True, False):
+        assert digest(rows, ordered) == digest(same, ordered)
+        assert digest(rows, ordered) != \
+            digest([{'a': memoryview(b'\x00\x02'), 'b': 1}], ordered)
+
+
+def test_unordered_bytea():
+    assert compare([{'a': b'\x00'}], [[{'a': memoryview(b'\x00')}]],
+                   ordered=False).equal()
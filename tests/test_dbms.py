@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('pg_import')
+
+from db_test.dbms import numeric_placeholders  # noqa: E402
+
+
+def test_numeric_placeholders():
+    assert numeric_placeholders(
+        'select * from t where a = %(a)s and b = %(b)s or c = %(a)s;') == (
+        'select * from t where a = $1 and b = $2 or c = $1', ['a', 'b'])
+
+
+def test_numeric_placeholders_percent():
+    assert numeric_placeholders("select 'a%%' || %(x)s") == (
+        "select 'a%' || $1", ['x'])
+    assert numeric_placeholders("select 1 %% 2") == ('select 1 % 2', [])
+
+
+def test_numeric_placeholders_not_preparable():
+    assert numeric_placeholders('select 1; select 2') is None
+    assert numeric_placeholders('select %s') is None
+    assert numeric_placeholders('create table t (a int)') is None
+    assert numeric_placeholders('call p(%(a)s)') is None
+
+
+def test_numeric_placeholders_dml():
+    assert numeric_placeholders(
+        '  with x as (select 1) insert into t values (%(v)s)') == (
+        'with x as (select 1) insert into t values ($1)', ['v'])
@@ -0,0 +1,62 @@
+import os
+
+from db_test.discovery import DiscoveryCache
+
+
+def touch(f_path, text):
+    f_path.write_text(text)
+    # mtime of the next write has to differ even on coarse file systems
+    st = os.stat(str(f_path))
+    os.utime(str(f_path), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_cache_hit(tmp_path):
+    module = tmp_path / 'test_a.py'
+    touch(module, 'tests = []')
+    f_path = str(module)
+
+    cache = DiscoveryCache(str(tmp_path / 'cache'), str(tmp_path))
+    assert cache.tests(f_path) is None
+    cache.put(f_path, [{'id': 1}])
+    cache.put_validated(([('1. test', {'id': 1})], []))
+    cache.save()
+
+    cache = DiscoveryCache(str(tmp_path / 'cache'), str(tmp_path))
+    assert cache.tests(f_path) == [{'id': 1}]
+    assert cache.validated() == ([('1. test', {'id': 1})], [])
+
+
+def test_cache_invalidated_by_change(tmp_path):
+    module = tmp_path / 'test_a.py'
+    touch(module, 'tests = []')
+    f_path = str(module)
+    cache = DiscoveryCache(str(tmp_path / 'cache'), str(tmp_path))
+    cache.tests(f_path)
+    cache.put(f_path, [{'id': 1}])
+    cache.put_validated(([], []))
+    cache.save()
+
+    touch(module, 'tests = [1]')
+    cache = DiscoveryCache(str(tmp_path / 'cache'), str(tmp_path))
+    assert cache.tests(f_path) is None
+    assert cache.validated() is None
+
+
+def test_cache_skips_unpicklable(tmp_path):
+    module = tmp_path / 'test_a.py'
+    touch(module, 'tests = []')
+    f_path = str(module)
+    cache = DiscoveryCache(str(tmp_path / 'cache'), str(tmp_path))
+    cache.tests(f_path)
+    cache.put(f_path, [{'id': 1, 'params_generator': lambda p: p}])
+    cache.save()
+
+    cache = DiscoveryCache(str(tmp_path / 'cache'), str(tmp_path))
+    assert cache.tests(f_path) is None
+
+
+def test_broken_cache_file(tmp_path):
+    cache = DiscoveryCache(str(tmp_path), str(tmp_path))
+    with open(cache.path, 'wb') as f:
+        f.write(b'not a pickle')
+    assert DiscoveryCache(str(tmp_path), str(tmp_path)).modules == {}
@@ -0,0 +1,54 @@
+import json
+
+from db_test import explain
+
+
+def notice(duration, plan):
+    return 'NOTICE:  duration: %s ms  plan:\n%s\n' % (
+        duration, json.dumps({'Query Text': 'select', 'Plan': plan},
+                             indent=2))
+
+
+plan = {
+    'Node Type': 'Hash Join',
+    'Shared Hit Blocks': 10,
+    'Shared Read Blocks': 5,
+    'Plans': [
+        {'Node Type': 'Seq Scan', 'Relation Name': 'orders'},
+        {'Node Type': 'Hash', 'Plans': [
+            {'Node Type': 'Index Scan', 'Relation Name': 'users'},
+        ]},
+    ],
+}
+
+
+def test_parse_notice():
+    assert explain.parse_notice(notice(1.5, plan)) == (1.5, plan)
+    assert explain.parse_notice('NOTICE:  table "t" does not exist\n') \
+        is None
+
+
+def test_plan_stats():
+    stats = explain.plan_stats([
+        notice(1.5, plan),
+        'NOTICE:  something else\n',
+        notice(0.25, {'Node Type': 'Seq Scan', 'Relation Name': 'items',
+                      'Shared Hit Blocks': 1}),
+    ])
+    assert stats == {'duration_ms': 1.75, 'shared_buffers': 16,
+                     'seq_scans': ['orders', 'items']}
+
+
+def test_violations():
+    stats = {'duration_ms': 12.5, 'shared_buffers': 100,
+             'seq_scans': ['orders']}
+    assert explain.violations({'max_duration_ms': 20,
+                               'max_shared_buffers': 100,
+                               'forbid_seq_scan': False}, stats) == []
+    assert explain.violations({'max_duration_ms': 10,
+                               'max_shared_buffers': 50,
+                               'forbid_seq_scan': True}, stats) == [
+        'duration 12.500 ms exceeds max_duration_ms 10',
+        '100 shared buffers exceed max_shared_buffers 50',
+        'seq scan on orders',
+    ]
@@ -0,0 +1,28 @@
+from db_test import impact
+
+
+def test_normalize():
+    assert impact.normalize('Users') == 'public.users'
+    assert impact.normalize('Billing.Users') == 'billing.users'
+    assert impact.normalize('"Billing".users') == 'Billing.users'
+    assert impact.normalize('billing."Users"') == 'billing.Users'
+
+
+def test_name_re():
+    names_re = impact.name_re({'public.users', 'billing.invoice'})
+    assert names_re.search('select * from users')
+    assert names_re.search('select * from public.users')
+    assert names_re.search('select * from BILLING.Invoice')
+    assert not names_re.search('select * from invoice')
+    assert not names_re.search('select * from users_archive')
+    assert not names_re.search('select * from old_users')
+    assert not names_re.search('select * from other.users')
+
+
+def test_file_objects_of_removed_file(tmp_path):
+    # directory names of pg_export, the file itself does not exist
+    for kind in ('tables', 'materializedviews', 'functions'):
+        f_path = str(tmp_path / 'schema' / 'Billing' / kind / 'Stats.sql')
+        assert impact.file_objects(f_path) == {'billing.stats'}
+    assert impact.file_objects(
+        str(tmp_path / 'schema' / 'billing' / 'other' / 'stats.sql')) == set()
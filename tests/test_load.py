@@ -0,0 +1,21 @@
+from db_test import load
+
+
+def test_histogram():
+    # 0.05 ms, 0.3 ms and 0.4 ms, 3 ms
+    latencies = [0.00005, 0.0003, 0.0004, 0.003]
+    assert load.LoadGenerator.histogram(latencies) == [
+        (0.1, 1), (0.25, 0), (0.5, 2), (1, 0), (2.5, 0), (5, 1)]
+
+
+def test_histogram_slow():
+    assert load.LoadGenerator.histogram([6]) == [(float('inf'), 1)]
+
+
+def test_error_kind():
+    class SerializationFailure(Exception):
+        pgcode = '40001'
+
+    assert load.LoadGenerator.error_kind(SerializationFailure()) == \
+        'serialization failure'
+    assert load.LoadGenerator.error_kind(ValueError()) == 'ValueError'
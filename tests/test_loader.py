@@ -0,0 +1,36 @@
+import io
+
+from db_test import loader
+
+
+def test_copy_block_stops_at_terminator():
+    fp = io.StringIO('1\ta\n2\tb\n\\.\ninsert into t values (3);\n')
+    block = loader.CopyBlock(fp)
+    assert block.read() == '1\ta\n2\tb\n'
+    assert block.read() == ''
+    assert fp.readline() == 'insert into t values (3);\n'
+
+
+def test_copy_block_reads_by_size():
+    fp = io.StringIO('1\n2\n3\n\\.\r\n')
+    block = loader.CopyBlock(fp)
+    chunks = []
+    while True:
+        chunk = block.read(2)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert chunks == ['1\n', '2\n', '3\n']
+    assert fp.read() == ''
+
+
+def test_copy_block_without_terminator():
+    block = loader.CopyBlock(io.StringIO('1\n2\n'))
+    assert block.read() == '1\n2\n'
+    assert block.read() == ''
+
+
+def test_copy_re():
+    assert loader.copy_re.match('COPY public.t (a, b) FROM stdin;\n')
+    assert loader.copy_re.match('copy t from stdin;')
+    assert not loader.copy_re.match("copy t from '/tmp/t.csv';")
@@ -0,0 +1,54 @@
+import json
+from types import SimpleNamespace
+from xml.etree import ElementTree
+
+from db_test import report
+
+
+phases = [('db', 'schema', 0.5), ('db', 'total', 1.25)]
+
+
+def results():
+    def test(test_id, duration, timings):
+        return SimpleNamespace(data={'id': test_id, 'db': 'db'},
+                               name='%s. test' % test_id, duration=duration,
+                               timings=timings)
+    return [
+        (test(1, 0.25, {'sql': 0.2}), 'green| Passed'),
+        (test(2, 0.5, {}), 'red| Failed\nyellow|    expected 1 rows'),
+        (test(3, 0, {}), 'yellow| Skipped'),
+    ]
+
+
+def test_write_json(tmp_path):
+    f_name = str(tmp_path / 'report.json')
+    report.write_json(f_name, phases, results())
+    with open(f_name) as f:
+        data = json.load(f)
+    assert data['build'][1] == {'db': 'db', 'phase': 'total',
+                                'duration': 1.25}
+    assert [t['status'] for t in data['tests']] == \
+        ['passed', 'failed', 'skipped']
+    assert data['tests'][0]['timings'] == {'sql': 0.2}
+    assert data['duration'] == 0.75
+    assert report.read_durations(f_name) == {1: 0.25, 2: 0.5, 3: 0}
+
+
+def test_write_junit(tmp_path):
+    f_name = str(tmp_path / 'report.xml')
+    report.write_junit(f_name, phases, results())
+    build, suite = ElementTree.parse(f_name).getroot()
+    assert build.get('time') == '1.250000'
+    assert len(build) == 2
+    assert suite.get('tests') == '3'
+    assert suite.get('failures') == '1'
+    assert suite.get('skipped') == '1'
+    passed, failed, skipped = suite
+    assert passed.find('properties/property').attrib == {
+        'name': 'sql_time', 'value': '0.200000'}
+    assert failed.find('failure').text == 'Failed\n    expected 1 rows'
+    assert skipped.find('skipped').get('message') == 'Skipped'
+
+
+def test_slowest():
+    assert [t.data['id'] for t, _ in report.slowest(results(), 2)] == [2, 1]
@@ -0,0 +1,101 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('psycopg2')
+pytest.importorskip('pg_import')
+
+from db_test import runner  # noqa: E402
+from db_test import tests as tts  # noqa: E402
+
+
+def make_runner(shard, timings_file=None, parents=None):
+    ''' TestRunner with only the state used by shard_tests '''
+    test_runner = runner.TestRunner.__new__(runner.TestRunner)
+    test_runner.shard = shard
+    test_runner.timings_file = timings_file
+    test_runner.parents = parents or {}
+    test_runner.log = lambda *args: None
+    return test_runner
+
+
+def make_tests(*ids, **data):
+    return [SimpleNamespace(data=dict({'id': i, 'params': {}}, **data))
+            for i in ids]
+
+
+def ids(tests):
+    return [t.data['id'] for t in tests]
+
+
+def test_shard_tests_round_robin():
+    all_tests = make_tests(1, 2, 3, 4, 5)
+    shards = [make_runner((i, 2)).shard_tests(all_tests) for i in (1, 2)]
+    assert ids(shards[0]) == [1, 3, 5]
+    assert ids(shards[1]) == [2, 4]
+
+
+def test_shard_tests_keeps_groups():
+    all_tests = make_tests(1, 2, 3, 4)
+    parents = {1: None, 2: 1, 3: 2, 4: None}
+    shards = [make_runner((i, 2), parents=parents).shard_tests(all_tests)
+              for i in (1, 2)]
+    assert ids(shards[0]) == [1, 2, 3]
+    assert ids(shards[1]) == [4]
+
+
+def test_shard_tests_global_params():
+    all_tests = make_tests(1, 2, 3) + make_tests(4, sql='select %(token)s')
+    all_tests[0].data['global_params_by_sql'] = 'select 1 as token'
+    shards = [make_runner((i, 2)).shard_tests(all_tests) for i in (1, 2)]
+    # 1 and 4 are one group, then 2 and 3 go to different shards
+    assert ids(shards[0]) == [1, 3, 4]
+    assert ids(shards[1]) == [2]
+
+
+def test_shard_tests_by_timings(tmp_path):
+    timings = tmp_path / 'report.json'
+    timings.write_text(json.dumps({'tests': [
+        {'id': 1, 'duration': 10}, {'id': 2, 'duration': 1},
+        {'id': 3, 'duration': 1}, {'id': 4, 'duration': 8}]}))
+    # 5 takes the mean duration (5)
+    all_tests = make_tests(1, 2, 3, 4, 5)
+    shards = [make_runner((i, 2), str(timings)).shard_tests(all_tests)
+              for i in (1, 2)]
+    assert ids(shards[0]) == [1, 2, 3]
+    assert ids(shards[1]) == [4, 5]
+    assert sorted(ids(shards[0] + shards[1])) == [1, 2, 3, 4, 5]
+
+
+def python_tests(*names):
+    classes = [type(name, (), {'test_a': lambda self: None,
+                               'test_b': lambda self: None})
+               for name in names]
+    return [tts.PythonTests(cls, None, None) for cls in classes]
+
+
+def class_names(python_tests):
+    return [pt.plugin_class.__name__ for pt in python_tests]
+
+
+def test_shard_python_tests():
+    all_tests = python_tests('C', 'A', 'B')
+    shards = [make_runner((i, 2)).shard_python_tests(all_tests)
+              for i in (1, 2)]
+    assert class_names(shards[0]) == ['C', 'A']
+    assert class_names(shards[1]) == ['B']
+
+
+def test_shard_python_tests_by_timings(tmp_path):
+    timings = tmp_path / 'report.json'
+    timings.write_text(json.dumps({'tests': [
+        {'id': 'A.test_a', 'duration': 1}, {'id': 'A.test_b', 'duration': 1},
+        {'id': 'B.test_a', 'duration': 1}, {'id': 'C.test_a', 'duration': 5},
+        {'id': 1, 'duration': 100}]}))
+    all_tests = python_tests('A', 'B', 'C')
+    shards = [make_runner((i, 2), str(timings)).shard_python_tests(all_tests)
+              for i in (1, 2)]
+    # C (5 + mean of its missing test_b) is heavier than A and B together
+    assert class_names(shards[0]) == ['C']
+    assert class_names(shards[1]) == ['A', 'B']
@@ -0,0 +1,40 @@
+from db_test import sources
+
+
+def test_function_signatures():
+    text = '''
+        CREATE OR REPLACE FUNCTION Billing.Pay(
+            p_id   integer,
+            p_sum  numeric(12, 2) default round(0.0, 2))
+        RETURNS void AS $$ select 1 $$ LANGUAGE sql;
+
+        create procedure "Audit".log(text) as $$ $$ language sql;
+    '''
+    assert sources.function_signatures(text) == [
+        '"audit".log(text)',
+        'billing.pay(p_id integer, p_sum numeric(12, 2) '
+        'default round(0.0, 2))',
+    ]
+
+
+def test_function_signatures_change_of_arguments():
+    old = 'create function f(a int) returns int as $$ select a $$'
+    body = 'create function f(a int) returns int as $$ select a + 1 $$'
+    args = 'create function f(a int, b int) returns int as $$ select a $$'
+    assert sources.function_signatures(old) == \
+        sources.function_signatures(body)
+    assert sources.function_signatures(old) != \
+        sources.function_signatures(args)
+
+
+def test_function_signatures_without_functions():
+    assert sources.function_signatures('create table t (a int);') == []
+
+
+def test_file_manifest_of_function(tmp_path):
+    f_path = tmp_path / 'f.sql'
+    f_path.write_text('create function f(a int) returns int '
+                      'as $$ select a $$ language sql;')
+    sha1, signatures = sources.file_manifest(str(f_path), function=True)
+    assert signatures == ['f(a int)']
+    assert sources.file_manifest(str(f_path)) == [sha1, []]
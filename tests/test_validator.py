@@ -0,0 +1,59 @@
+from db_test.validator import Validator
+
+
+def definition(test_id, **data):
+    ''' Test with required keys, inherited tests define only their own '''
+    if 'parent' not in data:
+        data = dict({'sql': 'select 1', 'result': [], 'db': 'db'}, **data)
+    return dict({'id': test_id, 'name': 'test %s' % test_id}, **data)
+
+
+def test_resolve_parents_merges_chain():
+    resolved, errors = Validator([
+        definition(1, params={'a': 1, 'b': 1}),
+        definition(2, parent=1, params={'b': 2}, sql='select 2'),
+        definition(3, parent=2, result=[{'x': 1}]),
+    ]).resolve_parents()
+    assert errors == {}
+    assert resolved[3]['sql'] == 'select 2'
+    assert resolved[3]['params'] == {'a': 1, 'b': 2}
+    assert resolved[3]['result'] == [{'x': 1}]
+    assert 'parent' not in resolved[3]
+
+
+def test_resolve_parents_keeps_definitions():
+    tests = [definition(1, params={'a': 1}), definition(2, parent=1, params={'b': 2})]
+    Validator(tests).resolve_parents()
+    assert tests[1] == definition(2, parent=1, params={'b': 2})
+
+
+def test_resolve_parents_missing_parent():
+    resolved, errors = Validator([
+        definition(1, parent=5),
+        definition(2, parent=1),
+        definition(3),
+    ]).resolve_parents()
+    assert set(resolved) == {3}
+    assert "'5' is not presented" in errors[1]
+    assert errors[2] == errors[1]
+
+
+def test_resolve_parents_loop():
+    resolved, errors = Validator([
+        definition(1, parent=3),
+        definition(2, parent=1),
+        definition(3, parent=2),
+        definition(4, parent=1),
+        definition(5, parent=5),
+    ]).resolve_parents()
+    assert resolved == {}
+    for test_id in (1, 2, 3):
+        assert errors[test_id].startswith('Parent loop: ')
+    assert errors[4] == errors[1]
+    assert errors[5] == 'Parent loop: 5 -> 5'
+
+
+def test_validate_reports_broken_chain():
+    correct, broken = Validator([definition(1), definition(2, parent=7)]).validate()
+    assert [name for name, data in correct] == ['1. test 1']
+    assert broken[0][0] == '2. test 2'